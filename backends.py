@@ -0,0 +1,221 @@
+import httplib
+import io
+import os
+import Queue
+import threading
+import traceback
+import urlparse
+import zipfile
+
+import config
+import manifest
+import results
+import utils
+
+
+# backends provide the levels of free mode and store the results of completed levels
+# every backend implements:
+# - get_level(): returns the path of a level file to play, or None if there is none (called from a background thread)
+# - level_hash(source): returns the content hash of a level obtained from the backend, or None if it isn't known
+# - save_result(filename, labels, meta): stores a result in the background (see results.py for the arguments)
+# - flush(): waits for the results being stored, called when the application exits
+
+
+# levels and results stored in the local directories
+class FilesystemBackend(object):
+    def get_level(self):
+        return manifest.MANIFEST.random_level()
+
+    def level_hash(self, source):
+        entry = manifest.MANIFEST.entry(source)
+        return entry.hash if entry else None
+
+    def save_result(self, filename, labels, meta):
+        results.WRITER.put(os.path.join(config.result_directory, filename), labels, meta)
+
+    def flush(self):
+        results.WRITER.flush()
+
+
+# error raised when the server answers a request with an error status
+class ServerError(Exception):
+    pass
+
+
+# pool of persistent (keep-alive) connections to an http server, usable from several threads
+class ConnectionPool(object):
+    def __init__(self, url, size, timeout):
+        parsed = urlparse.urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.prefix = parsed.path.rstrip("/")
+        self.timeout = timeout
+        self._connection = httplib.HTTPSConnection if parsed.scheme == "https" else httplib.HTTPConnection
+
+        # connections are only opened when first needed
+        self._idle = Queue.LifoQueue()
+        for i in xrange(size):
+            self._idle.put(None)
+
+    # sends a request and returns (headers, body) of the response, waiting for a free connection if needed
+    # a request failing on a reused connection is tried again once on a new one, as the server may have closed it
+    def request(self, method, path, body=None, headers=None):
+        connection = self._idle.get()
+        try:
+            for attempt in (0, 1):
+                reused = connection is not None
+                if connection is None:
+                    connection = self._connection(self.host, self.port, timeout=self.timeout)
+                try:
+                    connection.request(method, self.prefix + path, body, headers or {})
+                    response = connection.getresponse()
+                    data = response.read()
+                    break
+                except (httplib.HTTPException, IOError):
+                    connection.close()
+                    connection = None
+                    if attempt or not reused:
+                        raise
+
+            if response.getheader("connection", "").lower() == "close":
+                connection.close()
+                connection = None
+            if response.status >= 300:
+                raise ServerError("%s %s: %d %s" % (method, path, response.status, response.reason))
+            return response.msg, data
+        finally:
+            self._idle.put(connection)
+
+
+# levels downloaded from a level server, and results uploaded to it in batches
+# - levels are downloaded ahead of time on a background thread, local levels being used while the server can't be reached
+# - results are first written to a spool directory, kept across runs, and uploaded from there by a background thread
+# - "download_directory" and "spool_directory" default to those of config.py
+# see stub_server.py for the protocol
+class HTTPBackend(object):
+    def __init__(self, url, download_directory=None, spool_directory=None):
+        self.pool = ConnectionPool(url, config.server_connections, config.server_timeout)
+        self.download_directory = download_directory or config.download_directory
+        self.spool_directory = spool_directory or config.spool_directory
+        # hashes of the downloaded levels, by path
+        self._hashes = {}
+        # levels downloaded ahead of time
+        self._levels = Queue.Queue(config.server_prefetch)
+        # set when new results are waiting to be uploaded
+        self._pending = threading.Event()
+        # held while uploading, so that results are never uploaded twice
+        self._upload_lock = threading.Lock()
+        # set when the background threads have to stop
+        self._stopped = threading.Event()
+
+        for d in (self.download_directory, self.spool_directory):
+            utils.make_directory(d)
+
+        self._threads = [threading.Thread(target=target) for target in (self._download, self._upload)]
+        for worker in self._threads:
+            worker.daemon = True
+            worker.start()
+
+    def get_level(self):
+        try:
+            return self._levels.get(timeout=config.server_timeout)
+        except Queue.Empty:
+            print "level server unavailable, using a local level"
+            return manifest.MANIFEST.random_level()
+
+    def level_hash(self, source):
+        if source in self._hashes:
+            return self._hashes[source]
+        entry = manifest.MANIFEST.entry(source)
+        return entry.hash if entry else None
+
+    def save_result(self, filename, labels, meta):
+        results.WRITER.put(os.path.join(self.spool_directory, filename), labels, meta,
+                           done=lambda path: self._pending.set())
+
+    # waits for the results being written, and makes a last attempt at uploading them
+    # results that can't be uploaded stay in the spool directory until the next run
+    def flush(self):
+        results.WRITER.flush()
+        try:
+            self.upload_pending()
+        except (ServerError, httplib.HTTPException, EnvironmentError) as e:
+            print "results kept for later upload: %s" % e
+
+    # stops the background threads, results not uploaded yet staying in the spool directory
+    def close(self):
+        self._stopped.set()
+        self._pending.set()
+        for worker in self._threads:
+            worker.join(config.server_timeout)
+
+    # downloads a level from the server, returning its path
+    def download_level(self):
+        headers, data = self.pool.request("GET", "/level")
+        path = os.path.join(self.download_directory, os.path.basename(headers["x-level-name"]))
+        utils.write_atomic(path, lambda f: f.write(data))
+        self._hashes[path] = headers.get("x-level-hash")
+        return path
+
+    # uploads the spooled results in batches, removing them once the server has stored them
+    def upload_pending(self):
+        with self._upload_lock:
+            spooled = sorted(f for f in os.listdir(self.spool_directory) if f.endswith(".npz"))
+            for start in xrange(0, len(spooled), config.upload_batch_size):
+                batch = spooled[start:start + config.upload_batch_size]
+
+                # a batch is sent as a single zip archive of result files
+                body = io.BytesIO()
+                with zipfile.ZipFile(body, "w", zipfile.ZIP_STORED) as archive:
+                    for f in batch:
+                        archive.write(os.path.join(self.spool_directory, f), f)
+                self.pool.request("POST", "/results", body.getvalue(), {"Content-Type": "application/zip"})
+
+                for f in batch:
+                    os.remove(os.path.join(self.spool_directory, f))
+
+    # background thread, keeping levels downloaded in advance
+    def _download(self):
+        delay = config.upload_retry_delay
+        while not self._stopped.is_set():
+            try:
+                path = self.download_level()
+                delay = config.upload_retry_delay
+            except Exception as e:
+                print "level download failed: %s" % e
+                self._stopped.wait(delay)
+                delay = min(delay * 2, config.upload_max_delay)
+                continue
+            # waits for room in the queue, checking regularly whether the backend was closed
+            while not self._stopped.is_set():
+                try:
+                    self._levels.put(path, timeout=1.0)
+                    break
+                except Queue.Full:
+                    pass
+
+    # background thread, uploading results whenever new ones are spooled (and results left from previous runs)
+    def _upload(self):
+        delay = config.upload_retry_delay
+        while not self._stopped.is_set():
+            try:
+                self.upload_pending()
+                delay = config.upload_retry_delay
+                self._pending.wait()
+                self._pending.clear()
+            except (ServerError, httplib.HTTPException, EnvironmentError) as e:
+                print "result upload failed, retrying in %gs: %s" % (delay, e)
+                self._stopped.wait(delay)
+                delay = min(delay * 2, config.upload_max_delay)
+            except Exception:
+                traceback.print_exc()
+                self._stopped.wait(delay)
+
+
+# returns the backend of the given name ("filesystem" or "http")
+def create(name):
+    if name == "filesystem":
+        return FilesystemBackend()
+    if name == "http":
+        return HTTPBackend(config.server_url)
+    raise ValueError("unknown backend: " + name)
@@ -0,0 +1,336 @@
+# Headless benchmark suite for the image hot paths of the game
+# Runs without opening a window, and reports throughput (pixels/second) and peak memory for every case,
+# comparing them against a stored baseline file
+#
+# usage: python benchmark.py [--sizes 256 1024 ...] [--repeat N] [--baseline FILE] [--save-baseline]
+
+import os
+# kivy would otherwise try to parse the benchmark's own command-line arguments
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+
+import argparse
+import json
+import multiprocessing
+import Queue
+import shutil
+import signal
+import tempfile
+import timeit
+
+import numpy as np
+from scipy import misc
+
+import config
+import masking
+import palette
+import utils
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# default synthetic map sizes (square, in pixels)
+SIZES = [256, 512, 1024, 2048, 4096, 8192]
+# fragment rotations to benchmark, in degrees
+ROTATIONS = [0, 30, 45, 90]
+# fragment sizes to benchmark, as the fraction of the map width they cover
+SCALES = [0.1, 0.25, 0.5]
+# thread counts to benchmark parallel validation with, on the largest fragments
+WORKERS = [1, 2, 4, 8]
+# relative slowdown from the baseline before a case is reported as a regression
+TOLERANCE = 0.2
+# forest color used in synthetic maps
+FOREST = (34, 85, 34)
+
+
+# returns a synthetic RGBA map of the given size, with a mix of forest-like and random colors
+def synthetic_map(size):
+    rng = np.random.RandomState(size)
+    data = rng.randint(0, 256, (size, size, 4)).astype(np.uint8)
+    data[:, :, 3] = 255
+
+    # most of the map is close enough to the forest color
+    near = rng.rand(size, size) < 0.9
+    noise = rng.randint(-5, 6, (np.count_nonzero(near), 3))
+    data[near, :3] = np.clip(np.asarray(FOREST) + noise, 0, 255)
+    return data
+
+
+# returns the files of a directory, or an empty list if it doesn't exist
+def list_files(directory):
+    if not os.path.exists(directory):
+        return []
+    return [os.path.join(directory, f) for f in sorted(os.listdir(directory))
+            if os.path.isfile(os.path.join(directory, f))]
+
+
+# returns the normalized coordinates of a fragment centered on the map and covering the given fraction of it
+def centered(scale):
+    start = (1.0 - scale) / 2
+    return start, start, start + scale, start + scale
+
+
+# returns the resident memory of the process, in bytes (linux only)
+def current_memory():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        return None
+
+
+# returns the peak resident memory of the process, in bytes
+def peak_memory():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# times "run" (after a call to "setup" before each repetition) and returns the best time in seconds
+def measure(setup, run, repeat):
+    best = None
+    for i in range(repeat):
+        args = setup()
+        start = timeit.default_timer()
+        run(*args)
+        elapsed = timeit.default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+# list of all benchmark cases, as (name, function, arguments) tuples
+# every case function returns (setup, run, pixels), "pixels" being the amount of pixels processed per run
+def cases(sizes, workdir):
+    levels = list_files(config.level_directory)
+    fragments = list_files(config.fragment_directory)
+
+    # writes synthetic maps to disk so that loading can be measured as well
+    maps = []
+    for size in sizes:
+        path = os.path.join(workdir, "synthetic_%d.png" % size)
+        misc.imsave(path, synthetic_map(size))
+        maps.append(("%dx%d" % (size, size), path))
+    maps += [(os.path.basename(l), l) for l in levels]
+
+    result = []
+    for name, path in maps:
+        result.append(("load " + name, case_load, (path,)))
+        result.append(("get_texture " + name, case_texture, (path,)))
+        result.append(("greyscale " + name, case_greyscale, (path,)))
+        result.append(("equalize " + name, case_equalize, (path,)))
+        result.append(("color field " + name, case_color_field, (path,)))
+        result.append(("quantize " + name, case_quantize, (path,)))
+        result.append(("palette color field " + name, case_palette_color_field, (path,)))
+
+        for scale in SCALES:
+            result.append(("update_texture %s scale=%.2f" % (name, scale), case_update_texture, (path, scale)))
+
+            # every rotation uses a different shipped fragment
+            for i, rotation in enumerate(ROTATIONS):
+                if fragments:
+                    result.append(("mask %s rot=%d scale=%.2f" % (name, rotation, scale),
+                                   case_mask, (path, fragments[i % len(fragments)], rotation, scale)))
+
+            # live feedback while the fragment is dragged
+            if fragments:
+                result.append(("estimate %s scale=%.2f" % (name, scale), case_estimate, (path, fragments[0], scale)))
+
+        # parallel validation, with the largest fragments only
+        if fragments:
+            for workers in WORKERS:
+                result.append(("mask %s scale=%.2f workers=%d" % (name, SCALES[-1], workers),
+                               case_mask, (path, fragments[0], 0, SCALES[-1], workers)))
+
+    # loading the fragments themselves
+    for fragment in fragments:
+        result.append(("load " + os.path.basename(fragment), case_load, (fragment,)))
+
+    return result
+
+
+# loading of a level or fragment from disk
+def case_load(path):
+    im = utils.ImageArray.load(path)
+    return lambda: (), lambda: utils.ImageArray.load(path), im.size
+
+
+# only measures building the texture buffer, since uploading it requires an OpenGL context
+def case_texture(path):
+    im = utils.ImageArray.load(path)
+    return lambda: (), lambda: im.get_buffer(), im.size
+
+
+# rebuilding the label overlay buffer of a centered region, as done after validating a fragment
+def case_update_texture(path, scale):
+    im = utils.ImageArray.load(path)
+    labels = masking.LabelPlane(im.rows, im.cols)
+    x, y, right, top = centered(scale)
+    top, bottom, left, right = (int((1.0 - top) * im.rows), int((1.0 - y) * im.rows),
+                                int(x * im.cols), int(right * im.cols))
+    return (lambda: (),
+            lambda: utils.texture_buffer(masking.overlay(labels.data[top:bottom, left:right])),
+            (bottom - top) * (right - left))
+
+
+# greyscale filter, over the whole image
+def case_greyscale(path):
+    im = utils.ImageArray.load(path)
+    return lambda: (), lambda: utils.ImageFilter.greyscale(im), im.size
+
+
+# histogram equalization filter, over the whole image
+def case_equalize(path):
+    im = utils.ImageArray.load(path)
+    return lambda: (), lambda: utils.ImageFilter.equalize(im), im.size
+
+
+# the labels are reset before every repetition, as validated fragments modify them
+# the forest color is picked at the center of the map, the same way the game does
+# - "workers" is the number of threads used for validation, used for regions above config.mask_parallel_threshold
+def case_mask(path, fragment, rotation, scale, workers=1):
+    config.mask_workers = workers
+    im = utils.ImageArray.load(path)
+    frag = masking.classify(utils.ImageArray.load(fragment).data)
+    x, y, right, top = centered(scale)
+    # the game computes the color field once, when the forest color is picked
+    forest = masking.ColorField(im, masking.pick_color(im, im.rows // 2, im.cols // 2))
+    return (lambda: (masking.LabelPlane(im.rows, im.cols),),
+            lambda labels: masking.mask(im, labels, forest, frag, rotation, x, y, right, top),
+            int(scale * im.rows) * int(scale * im.cols))
+
+
+# computation of the color field, once the forest color has been picked
+def case_color_field(path):
+    im = utils.ImageArray.load(path)
+    color = masking.pick_color(im, im.rows // 2, im.cols // 2)
+    return (lambda: (), lambda: masking.ColorField(im, color), im.rows * im.cols)
+
+
+# conversion of a map into a palette and index plane
+def case_quantize(path):
+    im = utils.ImageArray.load(path)
+    return lambda: (), lambda: palette.quantize(im.data), im.size
+
+
+# computation of the color field of a paletted map, distances being computed once per palette color
+def case_palette_color_field(path):
+    im = palette.quantize(utils.ImageArray.load(path).data)
+    color = masking.pick_color(im, im.rows // 2, im.cols // 2)
+    return (lambda: (), lambda: masking.ColorField(im, color), im.size)
+
+
+# validity estimate of a fragment being dragged
+def case_estimate(path, fragment, scale):
+    im = utils.ImageArray.load(path)
+    frag = masking.classify(utils.ImageArray.load(fragment).data)
+    x, y, right, top = centered(scale)
+    field = masking.ColorField(im, masking.pick_color(im, im.rows // 2, im.cols // 2))
+    return (lambda: (),
+            lambda: masking.estimate(field, frag, 0, x, y, right, top),
+            int(scale * im.rows) * int(scale * im.cols))
+
+
+# runs a single case and puts its results in the queue, meant to be run in its own process
+def run_case(queue, case, args, repeat):
+    try:
+        before = current_memory()
+        setup, run, pixels = case(*args)
+        best = measure(setup, run, repeat)
+        peak = peak_memory()
+        memory = peak - before if peak is not None and before is not None else peak
+        queue.put({"seconds": best, "pixels": pixels,
+                   "pixels_per_second": pixels / best if best else None, "peak_bytes": memory})
+    except Exception as e:
+        queue.put({"error": "%s: %s" % (type(e).__name__, e)})
+
+
+# waits for the results of a case run in its own process
+# a process dying without results, typically killed by the system for running out of memory, is reported as an error
+def wait_results(process, queue):
+    while True:
+        try:
+            return queue.get(timeout=1.0)
+        except Queue.Empty:
+            if not process.is_alive():
+                break
+
+    # the results may have been sent right before the process exited
+    try:
+        return queue.get(timeout=1.0)
+    except Queue.Empty:
+        pass
+    if process.exitcode == -getattr(signal, "SIGKILL", 9):
+        return {"error": "killed, most likely out of memory"}
+    return {"error": "process exited with code %s" % process.exitcode}
+
+
+# runs every case in a fresh process, so that peak memory is measured per case
+def run_all(sizes, repeat):
+    workdir = tempfile.mkdtemp(prefix="fd2_bench_")
+    results = {}
+    try:
+        for name, case, args in cases(sizes, workdir):
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_case, args=(queue, case, args, repeat))
+            process.start()
+            result = wait_results(process, queue)
+            process.join()
+            results[name] = result
+            report(name, result)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+# prints the results of a single case
+def report(name, result):
+    if "error" in result:
+        line = "%-45s  ERROR %s" % (name, result["error"])
+    else:
+        memory = result["peak_bytes"] / (1024.0 * 1024.0) if result["peak_bytes"] is not None else float("nan")
+        line = "%-45s %14.0f px/s %10.1f MB" % (name, result["pixels_per_second"] or 0, memory)
+    print line
+
+
+# compares results against the baseline and returns the names of the cases that regressed
+def compare(results, baseline):
+    regressions = []
+    print
+    print "%-45s %14s %14s %8s" % ("case", "px/s", "baseline", "ratio")
+    for name in sorted(results):
+        current = results[name].get("pixels_per_second")
+        previous = baseline.get(name, {}).get("pixels_per_second")
+        if current and previous:
+            ratio = current / previous
+            flag = "  REGRESSION" if ratio < 1.0 - TOLERANCE else ""
+            if flag:
+                regressions.append(name)
+            print "%-45s %14.0f %14.0f %7.2fx%s" % (name, current, previous, ratio, flag)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Headless benchmark of the Forest Defenders 2 image hot paths")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="synthetic map sizes, in pixels")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions per case (best time is kept)")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="baseline file to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    options = parser.parse_args()
+
+    results = run_all(options.sizes, options.repeat)
+
+    if options.save_baseline:
+        with open(options.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print "saved baseline to " + options.baseline
+    elif os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            regressed = compare(results, json.load(f))
+        if regressed:
+            print "%d case(s) regressed by more than %d%%" % (len(regressed), TOLERANCE * 100)
+            raise SystemExit(1)
+    else:
+        print "no baseline found at " + options.baseline + ", use --save-baseline to create one"
@@ -4,6 +4,65 @@
 level_directory = "levels/"
 # directory in which the fragments are stored (loaded automatically)
 fragment_directory = "fragments/"
+# directory in which large levels are stored once converted to tiles
+tile_directory = "tiles/"
+# directory in which level thumbnails are cached
+thumbnail_directory = "thumbnails/"
+# directory in which the texture atlases built by sprites.py are stored
+atlas_directory = "atlas/"
+# directory in which filtered versions of the levels are cached
+filter_cache_directory = "filtered/"
+# file in which the index of the level directory is kept between runs
+level_manifest = "level_manifest.json"
+# directory in which completed level results are saved
+result_directory = "results/"
+# name of the player saved with the results (see score.py), the name of the machine if None
+player_name = None
+# maximum number of results waiting to be saved in the background
+result_queue_size = 8
+
+
+# where free mode levels come from and where results go (see backends.py):
+# "filesystem" for the directories above, "http" for the level server at server_url (see stub_server.py)
+backend = "filesystem"
+# url of the level server
+server_url = "http://localhost:8000/"
+# number of persistent connections kept open to the level server
+server_connections = 2
+# timeout of the requests to the level server, in seconds
+server_timeout = 10.0
+# number of levels downloaded from the server in advance
+server_prefetch = 2
+# directory in which levels downloaded from the server are stored
+download_directory = "downloads/"
+# directory in which results wait to be uploaded to the server (kept across runs while the server can't be reached)
+spool_directory = "spool/"
+# maximum number of results uploaded to the server in a single request
+upload_batch_size = 16
+# delay before retrying a failed upload or download, in seconds (doubled after every failure, up to the maximum)
+upload_retry_delay = 1.0
+upload_max_delay = 60.0
+
+
+# whether to record the player's actions in every game, to replay them with replay.py
+record_sessions = True
+# directory in which game recordings are stored
+recording_directory = "recordings/"
+
+# levels wider or taller than this (in pixels) are loaded as memory-mapped tiles instead of all at once
+tile_threshold = 4096
+# size of the tiles, in pixels
+tile_size = 256
+
+# whether levels are kept as a palette of their colors and an index per pixel (see palette.py),
+# which takes less memory and speeds up picking the forest color (large tiled levels are never paletted)
+palette_levels = False
+# maximum number of colors in a level palette, levels with more colors are quantized to fit
+palette_max_colors = 65536
+# directory in which level palettes are cached
+palette_directory = "palettes/"
+# maximum size at which tiled levels are displayed, in pixels (a smaller pyramid level is used above it)
+tile_display_size = 1024
 
 
 # color to use for cursor overlay
@@ -11,6 +70,18 @@ fragment_directory = "fragments/"
 cursor_color = (0, 0, 1, 0.2)
 
 
+# filters applied to the displayed map when a level is loaded, as a list of (filter, options) pairs
+# (see utils.ImageFilter), for example [("greyscale", {}), ("stretch", {"low": 2, "high": 98})]
+# fragments are still validated against the original colors
+level_filters = []
+
+
+# size of the level thumbnails in training mode, in pixels
+thumbnail_size = 128
+# number of levels per page in training mode (the grid has 4 columns)
+levels_per_page = 8
+
+
 # percentage required for a level to be considered completed
 # format is float percentage, between 0.0 and 1.0 (100%)
 complete_percent = 0.5
@@ -22,8 +93,15 @@ cutter_downtime = 5.0
 
 # transparency level to use for fragments (non-normalized, 0-255 integer)
 fragment_transparency = 100
+# size of the texture atlas pages built by sprites.py, in pixels
+atlas_size = 1024
 # number of fragments per page (integer)
 fragment_count = 8
+# number of threads used to validate large fragments (1 validates on the main thread only)
+mask_workers = 1
+# minimum amount of map pixels under a fragment before validation is split across threads
+# below about a megapixel, handing the bands to the threads costs more than comparing them in parallel saves
+mask_parallel_threshold = 1024 * 1024
 # step to use when translating fragments, in pixels (float or integer)
 translate_step = 5
 # step to use when scaling fragments, in percentage offset
@@ -42,6 +120,9 @@ not_example = (0, 0, 0)
 forest_example = (0, 255, 0)
 # the threshold before a color is considered too far from the target forest color
 forest_threshold = 20
+# metric of the distance between colors: "l1" (sum of the channel differences)
+# or "perceptual" (weighted to be closer to the differences seen by the eye, see masking.color_distance)
+color_metric = "l1"
 # percent of forest under a fragment required for the fragment to be counted as valid
 # format is float percentage, between 0.0 and 1.0 (100%)
 forest_validation_rate = 0.8
@@ -49,5 +130,12 @@ forest_validation_rate = 0.8
 
 
 # only use this if you know what you're doing
-# displays various data useful when debugging
-debug_mode = False
+# times the hot paths of the game, displays frame and validation times on screen,
+# and writes them to trace_file on exit (viewable in chrome://tracing or https://ui.perfetto.dev)
+profiling = False
+# file in which the timings are written when profiling
+trace_file = "trace.json"
+# maximum number of timings kept when profiling (older ones are dropped)
+trace_max_events = 200000
+# whether to print how long every phase of the startup took, up to the first frame and the assets loaded after it
+startup_report = False
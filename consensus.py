@@ -0,0 +1,141 @@
+# Offline aggregation of the players' results into a consensus map per level
+# Every result of a level is streamed into memory-mapped per-pixel vote counts, which are then turned into
+# a consensus forest/not forest map and a per-pixel agreement map, without ever holding all results in memory
+# Levels are aggregated in parallel, one process per level
+#
+# usage: python consensus.py [--results DIR] [--output DIR] [--workers N] [--levels NAME ...]
+#
+# for every level, the output directory receives:
+# - NAME_consensus.npy: labels chosen by the majority of the players (see masking.py), unlabeled on ties
+# - NAME_agreement.npy: share of the votes going to the majority label (0-255), 0 where nobody voted
+# - NAME_consensus.json: number of results aggregated, level hash and label counts of the consensus
+
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+
+import numpy as np
+
+import config
+import masking
+import results
+
+
+# number of pixels processed at once when building the output maps
+CHUNK = 1 << 22
+
+
+# reads the metadata of a result file, returning (path, metadata), or (path, None) if the file can't be read
+def read_meta(path):
+    try:
+        return path, results.load_meta(path)
+    except Exception as e:
+        print "skipping %s: %s" % (path, e)
+        return path, None
+
+
+# groups the result files of a directory by level, returning a dictionary of output name -> (metadata, paths)
+# results are grouped by level name, hash and size, so that results of a level that has since changed stay apart
+def group_results(directory, pool, levels=None):
+    paths = [os.path.join(directory, f) for f in sorted(os.listdir(directory)) if f.endswith(".npz")]
+
+    groups = {}
+    for path, meta in pool.imap(read_meta, paths, chunksize=64):
+        if meta is None or (levels is not None and meta["level"] not in levels):
+            continue
+        key = (meta["level"], meta.get("hash"), meta["rows"], meta["cols"])
+        groups.setdefault(key, (meta, []))[1].append(path)
+
+    # levels with several versions get the start of their hash appended to their name
+    names = {}
+    for key in groups:
+        names[key[0]] = names.get(key[0], 0) + 1
+    return dict((key[0] if names[key[0]] == 1 else "%s_%s" % (key[0], (key[1] or "unknown")[:8]), group)
+                for key, group in groups.items())
+
+
+# aggregates the results of a level into its consensus and agreement maps
+# votes are accumulated as run boundaries: +1 where a run of a label starts and -1 where it ends,
+# so that each result costs as much as its number of runs, whatever the size of the map
+def aggregate(job):
+    name, meta, paths, output = job
+    rows, cols = meta["rows"], meta["cols"]
+    size = rows * cols
+
+    # run boundaries of the forest and not forest votes, memory-mapped next to the output
+    boundaries = np.memmap(tempfile.TemporaryFile(dir=output), dtype=np.int32, mode="w+", shape=(2, size + 1))
+    count = 0
+    for path in paths:
+        values, lengths, _ = results.load_runs(path)
+        if lengths.sum() != size:
+            print "skipping %s: size does not match the level" % path
+            continue
+
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        for i, label in enumerate((masking.FOREST, masking.NOT_FOREST)):
+            # runs of a single label never touch each other, so every start (and every end) is unique
+            selected = values == label
+            boundaries[i, starts[selected]] += 1
+            boundaries[i, ends[selected]] -= 1
+        count += 1
+
+    consensus = np.lib.format.open_memmap(os.path.join(output, name + "_consensus.npy"),
+                                          mode="w+", dtype=np.uint8, shape=(rows, cols))
+    agreement = np.lib.format.open_memmap(os.path.join(output, name + "_agreement.npy"),
+                                          mode="w+", dtype=np.uint8, shape=(rows, cols))
+    flat_consensus = consensus.reshape(-1)
+    flat_agreement = agreement.reshape(-1)
+
+    # running sums of the boundaries give the number of votes of each pixel, one chunk at a time
+    votes = np.zeros(2, np.int64)
+    counts = np.zeros(3, np.int64)
+    for start in xrange(0, size, CHUNK):
+        stop = min(size, start + CHUNK)
+        chunk = np.cumsum(boundaries[:, start:stop], axis=1, dtype=np.int64) + votes[:, None]
+        votes = chunk[:, -1]
+
+        forest, not_forest = chunk
+        total = forest + not_forest
+        labels = np.full(stop - start, masking.IGNORE, np.uint8)
+        labels[forest > not_forest] = masking.FOREST
+        labels[not_forest > forest] = masking.NOT_FOREST
+        flat_consensus[start:stop] = labels
+        flat_agreement[start:stop] = np.maximum(forest, not_forest) * 255 // np.maximum(total, 1)
+        counts += np.bincount(labels, minlength=3)
+
+    consensus.flush()
+    agreement.flush()
+    del consensus, agreement, boundaries
+
+    summary = {"level": meta["level"], "hash": meta.get("hash"), "rows": rows, "cols": cols, "results": count,
+               "counts": [int(c) for c in counts]}
+    with open(os.path.join(output, name + "_consensus.json"), "w") as f:
+        json.dump(summary, f, indent=1, sort_keys=True)
+    return name, summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Aggregation of the Forest Defenders 2 results into consensus maps")
+    parser.add_argument("--results", default=config.result_directory, help="directory containing the result files")
+    parser.add_argument("--output", default="consensus/", help="directory in which to write the consensus maps")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="number of processes")
+    parser.add_argument("--levels", nargs="+", help="names of the levels to aggregate (all of them by default)")
+    options = parser.parse_args()
+
+    if not os.path.exists(options.output):
+        os.makedirs(options.output)
+
+    pool = multiprocessing.Pool(options.workers)
+    try:
+        groups = group_results(options.results, pool, options.levels)
+        jobs = [(name, meta, paths, options.output) for name, (meta, paths) in sorted(groups.items())]
+        for name, summary in pool.imap_unordered(aggregate, jobs):
+            labeled = summary["counts"][masking.FOREST] + summary["counts"][masking.NOT_FOREST]
+            print "%-30s %8d results %6.1f%% labeled" % (name, summary["results"],
+                                                          100.0 * labeled / max(1, summary["rows"] * summary["cols"]))
+    finally:
+        pool.close()
+        pool.join()
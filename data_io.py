@@ -1,27 +1,35 @@
-import random
-import os
+import socket
 import time
 
+import backends
 import config
+import results
+
+
+# backend providing the levels and storing the results, chosen in config.py (see backends.py)
+BACKEND = backends.create(config.backend)
 
 
 # function used to obtain a level when in free mode
 # modify only this function if you ever want to change how to load levels
 def get_level():
-    # TODO: modify code here to load random level from server
-    # in the meantime, we just pick a random level from the level list
-
-    if os.path.exists(config.level_directory):
-        m = random.choice(os.listdir(config.level_directory))
-        return os.path.join(config.level_directory, m)
-    else:
-        return None
+    return BACKEND.get_level()
 
 
 # function used to save the user solution once a level has been completed
+# - "labels" is the LabelPlane of the map, saved in the background as run-length-encoded labels (see results.py)
+# - "source" is the path of the level, used to store the hash of the level with the result
+# the result is saved with the name of the player (see config.player_name), so that results can be scored per player
 # modify only this function if you ever want to change where solutions are stored
-def save_level(name, data):
-    # TODO: modify code here to send results to server
-    # in the meantime, we save the solution to a file
+def save_level(name, labels, source=None):
+    now = time.time()
+    meta = {"format": results.FORMAT, "level": name, "source": source,
+            "hash": BACKEND.level_hash(source) if source else None,
+            "rows": labels.rows, "cols": labels.cols, "counts": [int(c) for c in labels.counts], "time": now,
+            "player": config.player_name or socket.gethostname()}
+    BACKEND.save_result("%s_result_%d.npz" % (name, now * 1000), labels, meta)
+
 
-    data.save(os.path.join("results", name + "_result" + time.time() + ".png"))
+# function called when the application exits, waiting for the solutions being saved
+def flush():
+    BACKEND.flush()
@@ -0,0 +1,83 @@
+import os
+
+import config
+import masking
+import sprites
+import utils
+
+
+# fragment loaded in the registry, shared by every game
+class Fragment(object):
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.mtime = os.path.getmtime(path)
+
+        # decoded pixels and class map (forest/not-forest/ignore), both read-only
+        # scipy is slow to import, and only needed once fragments are read
+        from scipy import misc
+        self.pixels = misc.imread(path)
+        self.pixels.flags.writeable = False
+        self.classes = masking.classify(self.pixels)
+        self.classes.flags.writeable = False
+
+        # textures are created on first use, as they require the window to exist,
+        # and are regions of the fragment atlas if it's up to date (see sprites.py)
+        self._texture = None
+        self._preview = None
+
+    # opaque texture, displayed in the fragment box
+    @property
+    def texture(self):
+        if self._texture is None:
+            self._texture = sprites.fragment_texture(self.path)
+        if self._texture is None:
+            self._texture = utils.ImageArray(self.pixels.shape[0], self.pixels.shape[1], self.pixels).get_texture()
+        return self._texture
+
+    # translucent texture, displayed while the fragment is being placed on the map
+    @property
+    def preview(self):
+        if self._preview is None:
+            self._preview = sprites.fragment_texture(self.path, preview=True)
+        if self._preview is None:
+            image = utils.ImageArray(self.pixels.shape[0], self.pixels.shape[1], self.pixels)
+            image[:, :, 3] = config.fragment_transparency
+            self._preview = image.get_texture()
+        return self._preview
+
+
+# registry of all the fragments in a directory, loaded once and refreshed when files change
+class FragmentRegistry(object):
+    def __init__(self, directory):
+        self.directory = directory
+        # fragments, by file name
+        self.fragments = {}
+
+    # rescans the directory, only loading new or modified files
+    # fragments edited in place don't change the modification time of the directory, so every file is checked
+    def refresh(self):
+        if not os.path.exists(self.directory):
+            self.fragments = {}
+            return
+
+        fragments = {}
+        for f in os.listdir(self.directory):
+            path = os.path.join(self.directory, f)
+            if os.path.isfile(path):
+                fragment = self.fragments.get(f)
+                if fragment is None or fragment.mtime != os.path.getmtime(path):
+                    fragment = Fragment(path)
+                fragments[f] = fragment
+
+        self.fragments = fragments
+
+    # returns the fragments sorted by file name
+    # - "names" allows for obtaining only a specific set of fragments instead of all of them
+    def get(self, names=None):
+        self.refresh()
+        return [self.fragments[f] for f in sorted(self.fragments) if names is None or f in names]
+
+
+# registry of the fragment directory, shared across the whole application
+REGISTRY = FragmentRegistry(config.fragment_directory)
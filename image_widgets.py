@@ -1,14 +1,17 @@
+from kivy.clock import Clock
 from kivy.properties import ObjectProperty
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.button import Button
 from kivy.uix.image import Image
+from kivy.uix.label import Label
 from kivy.uix.scatter import Scatter
 from kivy.uix.widget import Widget
 
-import matplotlib.pyplot as plt  # FOR TESTING
-from scipy import misc, ndimage
+import time
 
 import config
+import masking
+import profiling
 import utils
 
 
@@ -27,24 +30,45 @@ class TreeWidget(Widget):
     pass
 
 
+# on-screen display of the frame times and of the hot path timings, only created when profiling
+class ProfilingOverlay(Label):
+    def __init__(self, **kwargs):
+        super(ProfilingOverlay, self).__init__(**kwargs)
+        Clock.schedule_interval(self.record_frame, 0)
+        Clock.schedule_interval(self.update, 0.5)
+
+    # records the time between two frames
+    def record_frame(self, dt):
+        profiling.record("frame", time.time() - dt, dt)
+
+    # displays the last, mean and maximum time of everything timed so far, in milliseconds
+    def update(self, dt):
+        stats = profiling.stats()
+        self.text = "\n".join("%s: %.1f ms (mean %.1f, max %.1f, %d calls)" % (
+            name, s.last * 1000, s.mean * 1000, s.max * 1000, s.count) for name, s in sorted(stats.items()))
+
+
 # widget that contains a fragment and its buttons
 class ScatterFragment(Scatter):
     # texture to apply to the image within the scatter
     tex = ObjectProperty()
     # layout containing the fragment buttons
     buttons = ObjectProperty()
+    # whether the fragment is expected to be valid where it currently is (None when it isn't on the map)
+    # the fragment is tinted accordingly
+    feedback = ObjectProperty(None, allownone=True)
 
-    def __init__(self, validate, cancel, image, **kwargs):
+    # - "fragment" is the registry Fragment to place
+    def __init__(self, validate, cancel, fragment, **kwargs):
         super(ScatterFragment, self).__init__(**kwargs)
 
         # callbacks for the validation and cancel buttons
         self.validate = validate
         self.cancel = cancel
 
-        # loading image from source and setting transparency
-        self.image_array = utils.ImageArray.load(image)
-        self.image_array[:, :, 3] = config.fragment_transparency
-        self.tex = self.image_array.get_texture()
+        # translucent texture, shared with every other scatter of the same fragment
+        self.fragment = fragment
+        self.tex = fragment.preview
 
         # boolean to prevent from trying to reload buttons when they're already present
         self.has_buttons = False
@@ -102,16 +126,52 @@ class ScatterFragment(Scatter):
 
 
 # widget that contains the map image and all the methods to interact with it
+# the map pixels are never modified, labels are kept separately and displayed as an overlay
 class ImageWidget(Image):
+    # texture displaying the labels over the map, created on the first refresh
+    overlay = ObjectProperty(None, allownone=True)
+
     def __init__(self, **kwargs):
         super(ImageWidget, self).__init__(**kwargs)
 
+        self.imdata = None
+        self.labels = None
+        # distance between two displayed pixels, in map pixels (above 1 for downsampled tiled maps)
+        self.step = 1
+
+    # displays a level that has already been loaded (see level_loader.Level)
+    def show(self, level):
+        self.overlay = None
+        self.imdata = level.imdata
+        self.labels = level.labels
+        self.step = level.step
+        self.texture = utils.array_texture(level.pixels)
+
+    # releases the map pixels, labels and textures
+    def clear(self):
+        self.imdata = None
+        self.labels = None
+        self.overlay = None
+        self.texture = None
+
+    # returns the (x, y, width, height) of the displayed map, given the position of the widget
+    # the map keeps its aspect ratio within the widget, so non-square maps leave bands on two of its sides
+    def image_rect(self, x, y):
+        width, height = self.norm_image_size
+        return x + (self.width - width) / 2.0, y + (self.height - height) / 2.0, width, height
+
+    # returns the normalized (0-1, from the bottom-left of the displayed map) coordinates of a point
+    # given in the coordinates of the widget's parent
+    def normalize(self, px, py):
+        x, y, width, height = self.image_rect(self.x, self.y)
+        return (px - x) / width, (py - y) / height
+
     # returns whether the given view intersects with the map at any point
     # required for checking collision with scatters, due to local/window coordinates
     def intersects(self, view):
-        im_x, im_y = self.to_window(*self.pos)
-        im_right = im_x + self.width
-        im_top = im_y + self.height
+        im_x, im_y, width, height = self.image_rect(*self.to_window(*self.pos))
+        im_right = im_x + width
+        im_top = im_y + height
 
         sc_x, sc_y = view.to_window(*view.pos)
         sc_right = sc_x + view.width
@@ -121,90 +181,40 @@ class ImageWidget(Image):
 
     # returns the normalized x, y, right and top values for a point that intersects the map
     def get_intersect_coords(self, view):
-        x, y = self.to_window(*self.pos)
+        x, y, width, height = self.image_rect(*self.to_window(*self.pos))
 
-        normalized = [(view.x - x) / self.width, (view.y - y) / self.height,
-                      (view.right - x) / self.width, (view.top - y) / self.height]
+        normalized = [(view.x - x) / width, (view.y - y) / height,
+                      (view.right - x) / width, (view.top - y) / height]
         return normalized
 
-    # method that compares a fragment to the map and masks the map accordingly
-    # - "forest" corresponds to our color target for forests
+    # refreshes the label overlay after the labels have changed
+    # - "rect" is the (top, bottom, left, right) region that changed, the whole overlay is re-uploaded if not given
+    @profiling.timed("refresh overlay")
+    def refresh(self, rect=None):
+        step = self.step
+        if rect is None or self.overlay is None:
+            labels = self.labels.region((0, self.labels.rows, 0, self.labels.cols), step)
+            self.overlay = utils.array_texture(masking.overlay(labels))
+        else:
+            # aligns the region on the displayed pixels
+            top, bottom, left, right = rect
+            top, left = top // step * step, left // step * step
+
+            labels = self.labels.region((top, bottom, left, right), step)
+            utils.blit_array(self.overlay, masking.overlay(labels), -(-self.labels.rows // step),
+                             (top // step, left // step))
+            self.canvas.ask_update()
+
+    # method that compares a fragment to the map and labels the map accordingly
+    # - "forest" is the ColorField of our color target for forests
     # - "scatter" is the fragment we have selected
     # - the other inputs are the normalized values obtained through "get_intersect_coords"
     def mask(self, forest, scatter, x, y, right, top):
-        # convert the bound (0-1) normalized coords to the size that corresponds in the map pixel data
-        local_x = int(max(0.0, x) * self.imdata.cols)
-        local_y = int((1.0 - max(0.0, y)) * self.imdata.rows)
-        local_right = int(min(1.0, right) * self.imdata.cols)
-        local_top = int((1.0 - min(1.0, top)) * self.imdata.rows)
-
-        # alternate coords that are not bounded, required for handling intersecting fragments
-        local_x_unbounded = int(x * self.imdata.cols)
-        local_top_unbounded = int((1.0 - top) * self.imdata.rows)
-
-        # size to resize the fragment to for array comparison
-        size = (int((right - x) * self.imdata.cols),
-                int((top - y) * self.imdata.cols))
-
-        # resize and rotate fragment pixel array according to the scatter parameters
-        fragment = ndimage.rotate(scatter.image_array[:, :, :3], scatter.rotation, order=0)
-        fragment = misc.imresize(fragment, size=size, interp='nearest')
-
-        progress = 0
-        off = 0
-        mask = {}
-        if config.debug_mode:
-            distribution = {}
-
-        # iterate over all the pixels in the map that are "underneath" fragment pixels
-        for row in xrange(local_top, local_y - 1):
-            for col in xrange(local_x, local_right - 1):
-
-                # ignore pixels that have already been previously labeled
-                if tuple(self.imdata[row, col, :3]) not in [config.forest_example, config.not_example]:
-                    index = tuple(fragment[row - local_top_unbounded, col - local_x_unbounded, :3])
-
-                    if index == config.forest_example:
-                        dif = 0
-                        # compute difference from target color
-                        for chan in xrange(3):
-                            dif += abs(forest[chan] - self.imdata[row, col, chan])
-
-                        if config.debug_mode:
-                            distribution[dif] = distribution.get(dif, 0) + 1
-
-                        # consider the pixel "potentially wrong" if it's above the threshold
-                        if dif > config.forest_threshold:
-                            off += 1
-                    elif index == config.not_example:
-                        pass
-                    else:
-                        continue
-
-                    # register map masking according to the labeling
-                    progress += 1
-                    mask[(row, col)] = index
-
-        # total fragment size
-        total = (local_right - local_x) * (local_y - local_top)
-
-        # displays debug information about difference distribution
-        if config.debug_mode:
-            if distribution:
-                print "  min:", min(distribution.values()), "; max:", max(distribution.values())
-                print (total - off) / (total * 1.0), "% of area is forest"
-            plt.plot(distribution.keys(), distribution.values())
-            plt.ylabel("Frequency")
-            plt.xlabel("Difference from target")
-            plt.show()
-
-        # fragment is valid if there are more "correct" pixels than the validation rate
-        valid = (total - off) / (total * 1.0) >= config.forest_validation_rate
-
-        # applies the mask if the fragment is validated
+        valid, progress, rect = masking.mask(self.imdata, self.labels, forest, scatter.fragment.classes,
+                                             scatter.rotation, x, y, right, top)
+
+        # refreshes the part of the map that was labeled
         if valid:
-            for pixel in mask:
-                self.imdata[pixel[0], pixel[1], :3] = mask[pixel]
-            self.texture = self.imdata.get_texture()
+            self.refresh(rect)
 
         return valid, progress
@@ -0,0 +1,128 @@
+from kivy.clock import mainthread
+
+import Queue
+import threading
+import traceback
+
+import config
+import data_io
+import masking
+import palette
+import profiling
+import tiles
+import utils
+
+
+# level decoded and ready to be displayed, created outside of the main thread if needed
+class Level(object):
+    @profiling.timed("load level")
+    def __init__(self, source):
+        self.source = source
+
+        # large levels are loaded as memory-mapped tiles, and displayed from the pyramid level that fits the screen
+        if tiles.is_large(source):
+            self.imdata = tiles.open_level(source)
+            self.labels = tiles.TiledLabelPlane(self.imdata.rows, self.imdata.cols)
+            self.pixels, self.step = self.imdata.render(config.tile_display_size)
+        elif config.palette_levels:
+            self.imdata = palette.load(lambda: utils.ImageArray.load(source).data, data_io.BACKEND.level_hash(source))
+            self.labels = masking.LabelPlane(self.imdata.rows, self.imdata.cols)
+            self.pixels, self.step = self.imdata.pixels(), 1
+        else:
+            self.imdata = utils.ImageArray.load(source)
+            self.labels = masking.LabelPlane(self.imdata.rows, self.imdata.cols)
+            self.pixels, self.step = self.imdata.data, 1
+
+        # the displayed map goes through the configured filters, cached per level
+        if config.level_filters:
+            rows, cols = self.pixels.shape[:2]
+            self.pixels = utils.FilterPipeline(config.level_filters).apply_cached(
+                utils.ImageArray(rows, cols, data=self.pixels), data_io.BACKEND.level_hash(source)).data
+
+
+# level being loaded in the background, with the callback to call once it's ready
+class PendingLevel(object):
+    def __init__(self):
+        self.level = None
+        self.done = False
+        self.callback = None
+
+
+# loads levels on a background thread, keeping the next free mode level ready in advance
+class LevelLoader(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = Queue.Queue()
+        # next random level, loaded (or being loaded) in advance
+        self._next = None
+
+        worker = threading.Thread(target=self._work)
+        worker.daemon = True
+        worker.start()
+
+    # returns whether the next random level has already been loaded
+    def ready(self):
+        with self._lock:
+            return self._next is not None and self._next.done
+
+    # starts loading the next random level in advance, if it isn't already
+    def prefetch(self):
+        with self._lock:
+            if self._next is None:
+                self._next = self._submit(data_io.get_level)
+
+    # obtains a random level and calls "callback" with its Level on the main thread (None if there is none)
+    # the level loaded in advance is used if there is one, and the following one starts loading right after
+    def load_random(self, callback):
+        self.prefetch()
+        with self._lock:
+            pending, self._next = self._next, None
+            pending.callback = callback
+            done = pending.done
+
+        if done:
+            self._deliver(pending)
+        self.prefetch()
+
+    # loads the level at the given path, and calls "callback" with its Level on the main thread
+    def load(self, source, callback):
+        pending = self._submit(lambda: source)
+        with self._lock:
+            pending.callback = callback
+            done = pending.done
+        if done:
+            self._deliver(pending)
+
+    # queues a job loading the level at the path returned by "pick"
+    def _submit(self, pick):
+        pending = PendingLevel()
+        self._jobs.put((pending, pick))
+        return pending
+
+    # background thread, loading levels one after the other
+    def _work(self):
+        while True:
+            pending, pick = self._jobs.get()
+            level = None
+            try:
+                source = pick()
+                if source:
+                    level = Level(source)
+            except Exception:
+                traceback.print_exc()
+
+            with self._lock:
+                pending.level = level
+                pending.done = True
+                callback = pending.callback
+            if callback:
+                self._deliver(pending)
+
+    # calls the callback of a loaded level on the main thread
+    @mainthread
+    def _deliver(self, pending):
+        pending.callback(pending.level)
+
+
+# loader shared across the whole application
+LOADER = LevelLoader()
@@ -1,3 +1,7 @@
+# time at which the game started, for the startup report
+import time
+STARTED = time.time()
+
 # must be imported first to prevent issues
 from kivy.config import Config
 Config.set('graphics', 'width', 800)
@@ -5,36 +9,103 @@ Config.set('graphics', 'height', 600)
 
 from kivy.animation import Animation
 from kivy.app import App
-from kivy.clock import Clock
+from kivy.clock import Clock, mainthread
 from kivy.core.audio import SoundLoader
 from kivy.core.window import Window
-from kivy.graphics import Rectangle, Color
+from kivy.graphics import Color, InstructionGroup, Rectangle
 from kivy.lang import Builder
 from kivy.properties import ObjectProperty, StringProperty
 from kivy.uix.image import Image
 from kivy.uix.scatter import Scatter
 from kivy.uix.screenmanager import Screen, ScreenManager
 
-import gc
-import numpy as np
-import os
+import threading
+import traceback
 
 import config
 import data_io
+import fragment_registry
 import image_widgets as imw
-import utils
+import level_loader
+import manifest
+import masking
+import profiling
+import recording
+import sprites
+import thumbnails
+
 
+profiling.startup_phase("imports", STARTED)
 
-# loading widget instructions
-Builder.load_file('screens.kv')
-Builder.load_file('widgets.kv')
+# loading widget instructions, only those of the main menu until it's displayed (see "load_rules")
+Builder.load_file('menu.kv')
+profiling.startup_phase("kv rules")
 
 # ease-of-access for the only screenmanager in use
 MANAGER = None
-
-# pre-load game music
-musicA = SoundLoader.load("audio/A Forest Defenders 2 - Light.wav")
-musicB = SoundLoader.load("audio/B Forest Defenders 2 - Dense.wav")
+# whether the widget rules of the screens other than the main menu are loaded
+RULES_LOADED = False
+
+
+# loads the widget rules of the screens other than the main menu, if they aren't already
+def load_rules():
+    global RULES_LOADED
+    if not RULES_LOADED:
+        Builder.load_file('screens.kv')
+        Builder.load_file('widgets.kv')
+        RULES_LOADED = True
+
+
+# music track, only decoded once it's first needed instead of at startup
+# tracks are decoded whole, which takes a while, so they're loaded on a background thread
+class Music(object):
+    def __init__(self, path):
+        self.path = path
+        self.sound = None
+        self.loaded = False
+        # whether the track is being loaded in the background
+        self.loading = False
+
+    # starts playing the track in a loop, once it's loaded
+    # - "loaded" is called on the main thread once the track is loaded, with its sound (None if it can't be played)
+    def play(self, loaded=None):
+        if self.loaded:
+            self.start(loaded)
+        elif not self.loading:
+            self.loading = True
+
+            def work():
+                sound = None
+                try:
+                    sound = SoundLoader.load(self.path)
+                except Exception:
+                    traceback.print_exc()
+                self.sound_ready(sound, loaded)
+
+            worker = threading.Thread(target=work)
+            worker.daemon = True
+            worker.start()
+
+    # keeps the sound loaded in the background, and starts playing it
+    @mainthread
+    def sound_ready(self, sound, loaded):
+        self.sound = sound
+        self.loaded = True
+        self.loading = False
+        self.start(loaded)
+
+    # plays the loaded sound in a loop, and reports it to "loaded"
+    def start(self, loaded):
+        if self.sound:
+            self.sound.loop = True
+            self.sound.play()
+        if loaded:
+            loaded(self.sound)
+
+
+# game music
+musicA = Music("audio/A Forest Defenders 2 - Light.wav")
+musicB = Music("audio/B Forest Defenders 2 - Dense.wav")
 
 
 # specialized version of screen that handles keyboard presses and has a cursor system,
@@ -57,6 +128,12 @@ class KeyScreen(Screen):
         self.cursor_index = -1
         self.cursor = None
 
+    # prepares the screen to be shown again, every screen being built once and reused (see ScreenPool)
+    # screens taking arguments receive them here rather than in their constructor
+    def reset(self):
+        self.clear_cursor()
+        self.cursor_index = -1
+
     # initializes keyboard before the screen starts
     def on_pre_enter(self, *args):
         super(KeyScreen, self).on_pre_enter(*args)
@@ -72,6 +149,7 @@ class KeyScreen(Screen):
     def clear_cursor(self):
         if self.cursor:
             self.canvas.remove(self.cursor)
+            self.cursor = None
 
     # displays selection on currect cursor
     # setting offset to a value other than default (0) moves the cursor by that much
@@ -94,9 +172,10 @@ class KeyScreen(Screen):
                 self.canvas.ask_update()
 
                 # draws new cursor and forces refresh
-                with self.canvas:
-                    Color(rgba=config.cursor_color)
-                    self.cursor = Rectangle(pos=current.pos, size=current.size)
+                self.cursor = InstructionGroup()
+                self.cursor.add(Color(rgba=config.cursor_color))
+                self.cursor.add(Rectangle(pos=current.pos, size=current.size))
+                self.canvas.add(self.cursor)
                 self.canvas.ask_update()
 
     # action to take when pressing the "validate" button on the current cursor selection
@@ -133,10 +212,13 @@ class KeyScreen(Screen):
 
 
 class BackKeyScreen(KeyScreen):
-    def __init__(self, previous, **kwargs):
+    def __init__(self, **kwargs):
         super(BackKeyScreen, self).__init__(**kwargs)
+        self.previous = None
 
-        # set previous screen for back button
+    # - "previous" is the screen to return to with the back button
+    def reset(self, previous):
+        super(BackKeyScreen, self).reset()
         self.previous = previous
 
     # returns to previous screen
@@ -145,7 +227,8 @@ class BackKeyScreen(KeyScreen):
 
 
 class LoadingScreen(Screen):
-    pass
+    def reset(self):
+        pass
 
 
 # screen corresponding to the main menu
@@ -153,6 +236,7 @@ class MainMenuScreen(KeyScreen):
     # layout containing the screen's buttons, used for cursor function
     layout = ObjectProperty()
 
+    @profiling.timed("MainMenuScreen construction")
     def __init__(self, **kwargs):
         super(MainMenuScreen, self).__init__(**kwargs)
 
@@ -163,26 +247,27 @@ class MainMenuScreen(KeyScreen):
 
     # switches to the how to screen
     def howto(self):
-        self.manager.switch_to(HowToScreen(name="HowTo", previous=self), direction='left')
+        self.manager.switch_to(POOL.get(HowToScreen, previous=self), direction='left')
 
     # switches to the training mode menu
     def training_mode(self):
-        self.manager.switch_to(TrainingModeScreen(name="TrainingMode", previous=self), direction='left')
+        self.manager.switch_to(POOL.get(TrainingModeScreen, previous=self), direction='left')
 
-    # sets loading screen to switch to free mode
+    # switches to free mode once a random level is loaded in the background
+    # the loading screen is only displayed if the level wasn't already loaded in advance
     def free_mode(self):
-        self.manager.add_widget(LoadingScreen(name="Loading"))
-        self.manager.current = "Loading"
-        Clock.schedule_once(lambda x: self.launch_free_mode(), 1)
-
-    # launches new game in free mode after obtaining a random level
-    def launch_free_mode(self):
-        level = data_io.get_level()
+        if not level_loader.LOADER.ready():
+            self.manager.switch_to(POOL.get(LoadingScreen), direction='left')
+        level_loader.LOADER.load_random(self.launch_free_mode)
 
+    # launches new game in free mode with the loaded level, or returns to the menu if there is none
+    def launch_free_mode(self, level):
         if level:
-            self.manager.switch_to(GameScreen(name="Game", previous=self,
-                                              image_set=imw.ImageSet(raw=level)),
+            self.manager.switch_to(POOL.get(GameScreen, previous=self,
+                                            image_set=imw.ImageSet(raw=level.source, level=level)),
                                    direction='left')
+        elif self.manager.current != self.name:
+            self.manager.switch_to(self, direction='right')
 
 
 # "how to" screen
@@ -192,6 +277,7 @@ class HowToScreen(BackKeyScreen):
     # text contained on the screen, stored here for ease of reading
     text = StringProperty()
 
+    @profiling.timed("HowToScreen construction")
     def __init__(self, **kwargs):
         super(HowToScreen, self).__init__(**kwargs)
 
@@ -214,6 +300,7 @@ class TrainingModeScreen(BackKeyScreen):
     # layout containing the screen's buttons, used for cursor function
     layout = ObjectProperty()
 
+    @profiling.timed("TrainingModeScreen construction")
     def __init__(self, **kwargs):
         super(TrainingModeScreen, self).__init__(**kwargs)
 
@@ -224,8 +311,7 @@ class TrainingModeScreen(BackKeyScreen):
 
     # switches to level screen of the given difficulty
     def levels(self, difficulty):
-        self.manager.switch_to(TrainingLevelScreen(name="Training", previous=self,
-                                                   difficulty=difficulty, level_list=None),
+        self.manager.switch_to(POOL.get(TrainingLevelScreen, previous=self, difficulty=difficulty, level_list=None),
                                direction='left')
 
 
@@ -235,39 +321,82 @@ class TrainingLevelScreen(BackKeyScreen):
     layout = ObjectProperty()
     # grid containing the level maps
     grid = ObjectProperty()
+    # page and back buttons, for cursor use
+    bprev = ObjectProperty()
+    bnext = ObjectProperty()
+    bback = ObjectProperty()
     # level difficulty
     difficulty = StringProperty()
 
-    def __init__(self, difficulty, level_list, **kwargs):
+    @profiling.timed("TrainingLevelScreen construction")
+    def __init__(self, **kwargs):
         super(TrainingLevelScreen, self).__init__(**kwargs)
+        self.levels = []
+        self.page = 0
+
+        # cursor options
+        self.cursor_array = [self.bback, self.bnext, self.bprev]
+        self.cursor_reverse = True
+        self.cursor_wrap = True
+
+    # - "difficulty" is the difficulty of the levels to display
+    # - "level_list" optionally restricts them to the given names
+    def reset(self, previous, difficulty, level_list):
+        super(TrainingLevelScreen, self).reset(previous)
         self.difficulty = difficulty
 
-        # checks for the level directory and lists its files
-        if os.path.exists(config.level_directory):
-            for l in os.listdir(config.level_directory):
+        # levels of this difficulty (DIFFICULTY_NAME.png), optionally restricted to the names in "level_list"
+        self.levels = manifest.MANIFEST.levels(difficulty, level_list)
 
-                # checks the files with the correct naming conventions (DIFFICULTY_NAME.png)
-                split = l.split("_")
-                if split[0] == difficulty and (level_list is None or l[1] in level_list):
-                    levelpath = os.path.join(config.level_directory, l)
+        # only the current page of levels is displayed
+        self.page = 0
+        self.display_page()
 
-                    # loads files onto the grid
-                    if os.path.isfile(levelpath):
-                        img = Image(source=levelpath)
-                        img.bind(on_touch_down=self.select_level)
-                        self.grid.add_widget(img)
+    # displays the current page of levels in the grid, changing page by offset if possible
+    # widgets are only created for the visible levels, and their thumbnails are loaded in the background
+    def display_page(self, offset=0):
+        if 0 <= (self.page + offset) * config.levels_per_page < len(self.levels):
+            self.page += offset
 
-        # cursor options
-        self.cursor_array = self.layout.children[:-1]
-        self.cursor_reverse = True
-        self.cursor_wrap = True
+        self.grid.clear_widgets()
+        start = self.page * config.levels_per_page
+        for levelpath in self.levels[start:start + config.levels_per_page]:
+            img = Image(source="images/ajax-loader-light.gif")
+            img.level = levelpath
+            img.bind(on_touch_down=self.select_level)
+            self.grid.add_widget(img)
+
+            thumbnails.LOADER.request(levelpath, lambda path, img=img: self.show_thumbnail(img, path))
+
+    # displays a thumbnail once it's ready, unless its level has been paged out since
+    def show_thumbnail(self, img, path):
+        if path and img.parent is self.grid:
+            img.source = path
 
-    # launches the level corresponding to the selected image
+    # launches the level corresponding to the selected image once it's loaded in the background
     def select_level(self, view, touch):
         if view.collide_point(touch.x, touch.y) and not touch.is_mouse_scrolling:
-            self.manager.switch_to(GameScreen(name="Game", previous=self,
-                                              image_set=imw.ImageSet(raw=view.source)),
+            self.manager.switch_to(POOL.get(LoadingScreen), direction='left')
+            level_loader.LOADER.load(view.level, self.launch_level)
+
+    # launches new game with the loaded level, or comes back to the level list if it couldn't be loaded
+    def launch_level(self, level):
+        if level:
+            self.manager.switch_to(POOL.get(GameScreen, previous=self,
+                                            image_set=imw.ImageSet(raw=level.source, level=level)),
                                    direction='left')
+        else:
+            self.manager.switch_to(self, direction='right')
+
+    # horizontal arrows change pages, other keys move the cursor
+    def _on_keyboard_down(self, keyboard, keycode, text, modifiers):
+        key = keycode[1]
+        if key == "left":
+            self.display_page(-1)
+        elif key == "right":
+            self.display_page(1)
+        else:
+            super(TrainingLevelScreen, self)._on_keyboard_down(keyboard, keycode, text, modifiers)
 
 
 # screen that displays during game overs and victory
@@ -275,11 +404,16 @@ class GameOverScreen(KeyScreen):
     # title to display on the screen
     title = StringProperty()
 
-    def __init__(self, title, next_screen, **kwargs):
+    @profiling.timed("GameOverScreen construction")
+    def __init__(self, **kwargs):
         super(GameOverScreen, self).__init__(**kwargs)
-        self.title = title
+        self.next = None
 
-        # screen to return to on exit
+    # - "title" is the title to display
+    # - "next_screen" is the screen to return to on exit
+    def reset(self, title, next_screen):
+        super(GameOverScreen, self).reset()
+        self.title = title
         self.next = next_screen
 
     # pressing any key continues to the next screen
@@ -287,10 +421,8 @@ class GameOverScreen(KeyScreen):
         self.cont()
         return True
 
-    # continues to the next screen and activates the garbage collector to try to lower memory usage
+    # continues to the next screen
     def cont(self):
-        gc.collect()
-
         # checks whether to switch screens by name or object
         if self.next.name in self.manager.screen_names:
             self.manager.current = self.next.name
@@ -315,45 +447,134 @@ class GameScreen(KeyScreen):
     # box covering the fragment box before color has been picked
     color_picker = ObjectProperty()
 
+    @profiling.timed("GameScreen construction")
+    def __init__(self, **kwargs):
+        super(GameScreen, self).__init__(**kwargs)
+        self.previous = None
+        self.recording = None
+        self.picker = None
+        self.scatter = None
+        self.cutter_event = None
+        # distances of the map to the forest color, computed once it's been picked
+        self.color_field = None
+        # identifies the color field being computed in the background, None if there is none
+        self.color_job = None
+        # instructions of the color picker box, shown again in place of an error
+        self.picker_text = self.color_picker.text
+
+        # fragment widgets, by fragment file, kept from one game to the next
+        self.fragment_widgets = {}
+        # sapling image, put back in place of the grown tree at the start of every game
+        self.sapling = self.tree
+        # starting position of the chainsaw
+        self.cutter_start = dict(self.cutter.pos_hint)
+
+        # live validity feedback of the scatter being placed, updated at most once per frame
+        self.feedback_trigger = Clock.create_trigger(self.update_feedback)
+
+    # starts a new game
     # - "previous" is the screen this screen was launched from
-    # - "image_set" is an ImageSet object containing the map
+    # - "image_set" is an ImageSet object containing the map ("raw") and its loaded Level ("level")
     # - "fragment_list" allows for loading only a specific set of fragments instead of all of them
-    def __init__(self, previous, image_set, fragment_list=None, **kwargs):
-        super(GameScreen, self).__init__(**kwargs)
+    @profiling.timed("GameScreen reset")
+    def reset(self, previous, image_set, fragment_list=None):
+        super(GameScreen, self).reset()
+        # releases whatever is left of the previous game before loading the next map
+        self.release()
+
         # screen we came from, to pass on to game over/victory screen
         self.previous = previous
 
-        # set image for the map and prepare it for color selection
+        # set image for the map (loaded in the background beforehand) and prepare it for color selection
         self.source = image_set.sources["raw"]
-        self.image.imdata = utils.ImageArray.load(self.source)
+        self.image.show(image_set.sources["level"])
+        self.image.unbind(on_touch_down=self.color_drop)
         self.image.bind(on_touch_down=self.color_drop)
+        self.color_picker.text = self.picker_text
+        if self.color_picker.parent is None:
+            self.layout.add_widget(self.color_picker)
+
+        # records the player's actions, for replaying the game later
+        if config.record_sessions:
+            self.recording = recording.Recording(self.source, self.image.labels.rows, self.image.labels.cols,
+                                                 data_io.BACKEND.level_hash(self.source))
 
-        # loads fragments from fragment directory
+        # borrows fragments from the registry, which only reloads the fragment directory if it changed,
+        # reusing the widgets of the fragments that were already displayed in previous games
         self.f_index = 0
         self.fragments = []
-        if os.path.exists(config.fragment_directory):
-            for f in os.listdir(config.fragment_directory):
-                if fragment_list is None or f in fragment_list:
-                    imgpath = os.path.join(config.fragment_directory, f)
-                    if os.path.isfile(imgpath):
-                        img = Image(source=imgpath)
-                        img.bind(on_touch_down=self.im_press)
-                        self.fragments.append(img)
+        widgets = {}
+        for fragment in fragment_registry.REGISTRY.get(fragment_list):
+            img = self.fragment_widgets.get(fragment.path)
+            if img is None or img.fragment is not fragment:
+                img = Image(texture=fragment.texture)
+                img.fragment = fragment
+                img.bind(on_touch_down=self.im_press)
+            widgets[fragment.path] = img
+            self.fragments.append(img)
+        self.fragment_widgets.update(widgets)
+        self.label_box.clear_widgets()
 
         # cursor options
         self.cursor_active = False
         self.cursor_array = self.fragments
 
-        self.picker = None
-        self.scatter = None
-        self.cutter_event = None
+        # puts the chainsaw and the sapling back in their starting state
+        self.cutter.pos_hint = dict(self.cutter_start)
+        if self.tree is not self.sapling:
+            parent = self.tree.parent
+            parent.add_widget(self.sapling, parent.children.index(self.tree))
+            parent.remove_widget(self.tree)
+            self.tree = self.sapling
+        self.tree.height = self.tree.width
 
         # starting values
-        self.completion = 0
         self.tree_start = self.tree.height
         self.forest_color = None
         self.started = False
 
+    # stops everything still running in the game, and releases its map, labels and textures
+    def release(self):
+        if self.cutter_event:
+            self.cutter_event.cancel()
+            self.cutter_event = None
+        Animation.cancel_all(self.cutter)
+        Animation.cancel_all(self.tree)
+        self.feedback_trigger.cancel()
+
+        if self.scatter:
+            self.scatter.parent.remove_widget(self.scatter)
+            self.scatter = None
+        if self.picker:
+            self.remove_widget(self.picker)
+            self.picker = None
+
+        self.color_field = None
+        self.color_job = None
+        self.image.clear()
+
+    # writes the game recording and releases the game once the player leaves it
+    def on_leave(self, *args):
+        super(GameScreen, self).on_leave(*args)
+        self.end_recording("quit")
+        self.release()
+
+    # records an action of the player, if games are recorded
+    def record(self, type, **fields):
+        if self.recording:
+            self.recording.record(type, **fields)
+
+    # records the end of the game and writes the recording (only the first call has an effect)
+    def end_recording(self, outcome):
+        if self.recording:
+            self.recording.close(outcome, self.image.labels.counts)
+            self.recording = None
+
+    # number of labeled pixels on the map, kept up to date by the map's label plane
+    @property
+    def completion(self):
+        return self.image.labels.labeled
+
     # displays fragments in fragment box, changing index by offset if necessary
     def display_fragments(self, offset=0):
         # computes new fragment index if valid
@@ -375,15 +596,17 @@ class GameScreen(KeyScreen):
     def validate_scatter(self):
         if self.image.intersects(self.scatter):
             # attempts to apply the mask with the current scatter
-            valid, prog = self.image.mask(self.forest_color, self.scatter,
-                                          *self.image.get_intersect_coords(self.scatter))
+            coords = self.image.get_intersect_coords(self.scatter)
+            start = time.time()
+            valid, prog = self.image.mask(self.color_field, self.scatter, *coords)
+            self.record("validate", fragment=self.scatter.fragment.path, rotation=self.scatter.rotation,
+                        scale=self.scatter.scale, pos=list(self.scatter.pos), coords=coords,
+                        valid=valid, progress=prog, seconds=time.time() - start)
 
             # mask was validated
             if valid:
-                # increases completion and grows tree accordingly
-                self.completion += prog
-                completion_percent = self.completion * 1.0 / self.image.imdata.size
-                self.grow_tree(completion_percent)
+                # grows tree according to the new completion
+                self.grow_tree(self.completion * 1.0 / self.image.labels.size)
 
                 # reset the chainsaw's progression
                 self.reset_cutter()
@@ -396,6 +619,7 @@ class GameScreen(KeyScreen):
 
     # cancels a scatter without applying it
     def cancel_scatter(self):
+        self.record("cancel")
         self.remove_widget(self.scatter)
         self.scatter = None
 
@@ -405,15 +629,16 @@ class GameScreen(KeyScreen):
         if not touch or (self.image.collide_point(touch.x, touch.y) and not touch.is_mouse_scrolling):
             # convert coordinates to normalized
             coords = (touch.x, touch.y) if touch else self.picker.pos
-            x, y = (coords[0] - self.image.x) / self.image.width, (coords[1] - self.image.y) / self.image.height
+            x, y = self.image.normalize(*coords)
 
             if 0.0 <= x <= 1.0 and 0.0 <= y <= 1.0:
                 # convert coordinates to pixel array indices
                 row, col = int((1 - y) * self.image.imdata.rows), int(x * self.image.imdata.cols)
 
                 # gets color by doing mean around cursor selection
-                self.forest_color = np.mean(np.mean(self.image.imdata[row-2:row+2, col-2:col+2], axis=0), axis=0)
-                self.forest_color = map(lambda c: int(c), self.forest_color)
+                self.forest_color = masking.pick_color(self.image.imdata, row, col)
+                self.build_color_field(self.forest_color)
+                self.record("color", row=row, col=col, color=self.forest_color)
 
                 # destroys color picker cursor and box
                 self.image.unbind(on_touch_down=self.color_drop)
@@ -423,11 +648,48 @@ class GameScreen(KeyScreen):
                     self.remove_widget(self.picker)
                     self.picker = None
 
-                # activates cursor mode for fragments and displays them
-                self.cursor_active = True
-                self.display_fragments()
+    # computes the ColorField of the picked color on a background thread, as it takes seconds on large maps
+    # fragments are displayed once it's ready, as validating them and their feedback require it
+    def build_color_field(self, color):
+        imdata = self.image.imdata
+        job = self.color_job = object()
+
+        def work():
+            field = None
+            try:
+                field = masking.ColorField(imdata, color)
+            except Exception:
+                traceback.print_exc()
+            self.color_field_ready(job, field)
+
+        worker = threading.Thread(target=work)
+        worker.daemon = True
+        worker.start()
+
+    # uses the ColorField computed in the background, unless the game was left in the meantime
+    # if it couldn't be computed, the color picker is put back with an error, so that another color can be picked
+    @mainthread
+    def color_field_ready(self, job, field):
+        if job is not self.color_job:
+            return
+        self.color_job = None
+
+        if field is None:
+            self.forest_color = None
+            self.color_picker.text = "[color=#ff0000]This color could\nnot be used,\nplease pick\nanother one[/color]"
+            if self.color_picker.parent is None:
+                self.layout.add_widget(self.color_picker)
+            self.image.unbind(on_touch_down=self.color_drop)
+            self.image.bind(on_touch_down=self.color_drop)
+            return
+        self.color_field = field
+
+        # activates cursor mode for fragments and displays them
+        self.cursor_active = True
+        self.display_fragments()
 
     # method called when selecting a fragment
+    @profiling.timed("im_press")
     def im_press(self, view, touch=None):
         # check for collision
         if not touch or (view.collide_point(touch.x, touch.y) and not touch.is_mouse_scrolling):
@@ -435,11 +697,14 @@ class GameScreen(KeyScreen):
             if self.scatter:
                 self.cancel_scatter()
 
+            self.record("fragment", fragment=view.fragment.path)
+
             # create new scatter from selected fragment
             self.scatter = imw.ScatterFragment(validate=self.validate_scatter,
                                                cancel=self.cancel_scatter,
-                                               image=view.source)
+                                               fragment=view.fragment)
             self.scatter.bind(on_touch_up=self.im_release)
+            self.scatter.bind(transform=self.feedback_trigger)
 
             # set scatter options and display it
             self.scatter.im = view
@@ -455,6 +720,17 @@ class GameScreen(KeyScreen):
             if not self.started:
                 self.start_clock()
 
+    # estimates whether the scatter would be valid where it is, to tint it while it's being placed
+    def update_feedback(self, *args):
+        if not self.scatter:
+            return
+        if self.image.intersects(self.scatter):
+            self.scatter.feedback = masking.estimate(self.color_field, self.scatter.fragment.classes,
+                                                     self.scatter.rotation,
+                                                     *self.image.get_intersect_coords(self.scatter))[0]
+        else:
+            self.scatter.feedback = None
+
     # displays the buttons once the scatter has been let go of for the first time
     def im_release(self, scatter, touch):
         if scatter.collide_point(touch.x, touch.y) and touch.grab_current:
@@ -486,7 +762,8 @@ class GameScreen(KeyScreen):
         # if it's collided, the player has lost and we switch to the game over screen
         if self.cutter.collide_widget(self.tree):
             self.cutter_event.cancel()
-            MANAGER.switch_to(GameOverScreen(title="Game Over", next_screen=self.previous))
+            self.end_recording("lose")
+            MANAGER.switch_to(POOL.get(GameOverScreen, title="Game Over", next_screen=self.previous))
 
     # changes the tree's height to match the given completion state
     def grow_tree(self, completion_percent):
@@ -522,14 +799,19 @@ class GameScreen(KeyScreen):
         if self.cutter_event:
             self.cutter_event.cancel()
 
-        data_io.save_level(name=self.source.split("/")[1].split(".")[0], data=self.image.imdata)
+        data_io.save_level(name=self.source.split("/")[1].split(".")[0], labels=self.image.labels, source=self.source)
+        self.end_recording("win")
 
-        self.manager.switch_to(GameOverScreen(title="Success!", next_screen=self.previous))
+        self.manager.switch_to(POOL.get(GameOverScreen, title="Success!", next_screen=self.previous))
 
     # handles button presses in this screen
     def _on_keyboard_down(self, keyboard, keycode, text, modifiers):
         key = keycode[1]
 
+        # the picked color is still being processed, nothing can be picked or validated until it's done
+        if self.color_job:
+            return
+
         # we currently have a fragment selected
         if self.scatter:
             # move scatter around
@@ -592,10 +874,39 @@ class GameScreen(KeyScreen):
             # we initialize a new color picker
             else:
                 self.picker = Scatter(center=self.center)
-                self.picker.add_widget(Image(size=(50, 50), source="images/fd2_cursor.png"))
+                self.picker.add_widget(Image(size=(50, 50), source=sprites.sprite("images/fd2_cursor.png")))
                 self.add_widget(self.picker)
 
 
+# screen manager timing screen switches when profiling
+class TimedScreenManager(ScreenManager):
+    @profiling.timed("switch_to")
+    def switch_to(self, screen, **options):
+        super(TimedScreenManager, self).switch_to(screen, **options)
+
+
+# screens of the application, every type of screen being built once and reset each time it's shown again,
+# so that navigating doesn't build new widget trees and games don't leave their maps behind
+class ScreenPool(object):
+    def __init__(self):
+        self.screens = {}
+
+    # returns the screen of the given class, built on first use, after resetting it with the given arguments
+    def get(self, cls, **options):
+        screen = self.screens.get(cls)
+        if screen is None:
+            # in case the screen is needed before the rules are loaded after the first frame
+            if cls is not MainMenuScreen:
+                load_rules()
+            screen = self.screens[cls] = cls(name=cls.__name__[:-len("Screen")])
+        screen.reset(**options)
+        return screen
+
+
+# pool of the screens of the application
+POOL = ScreenPool()
+
+
 # main application class
 class ForestDefenders2App(App):
     # changes window title
@@ -605,20 +916,60 @@ class ForestDefenders2App(App):
         super(ForestDefenders2App, self).__init__(**kwargs)
 
         # initialize new ScreenManager for handling screens, and set it as global for ease of use
-        self.manager = ScreenManager()
+        self.manager = TimedScreenManager()
         global MANAGER
         MANAGER = self.manager
 
     def build(self):
-        # load and start playing game audio
-        if musicA:
-            musicA.loop = True
-            musicA.play()
+        profiling.startup_phase("window")
 
-        # set starting screen
-        self.manager.switch_to(MainMenuScreen(name="MainMenu"))
+        # set starting screen, everything else being loaded once it's displayed
+        self.manager.switch_to(POOL.get(MainMenuScreen))
+        Window.bind(on_flip=self.first_frame)
+
+        # display timings over every screen when profiling
+        if profiling.ENABLED:
+            Window.add_widget(imw.ProfilingOverlay())
+        profiling.startup_phase("main menu")
         return self.manager
 
+    # called once the main menu has been drawn for the first time
+    def first_frame(self, *args):
+        Window.unbind(on_flip=self.first_frame)
+        profiling.startup_phase("first frame")
+        Clock.schedule_once(self.load_assets)
+
+    # loads what the main menu doesn't need, screens loading anything still missing by themselves if used before
+    def load_assets(self, dt):
+        # load the widget rules of the other screens
+        load_rules()
+        profiling.startup_phase("screen rules")
+
+        # load all fragments once, now that textures can be created
+        fragment_registry.REGISTRY.refresh()
+        profiling.startup_phase("fragments")
+
+        # start loading the first free mode level in advance
+        level_loader.LOADER.prefetch()
+
+        # load and start playing game audio, in the background
+        musicA.play(self.music_loaded)
+
+    # called once the music has been loaded and started, which ends startup
+    def music_loaded(self, sound):
+        profiling.startup_phase("music")
+        if config.startup_report:
+            print profiling.startup_report()
+
+    def on_stop(self):
+        # write the recording of the game being played, if any, and wait for the results still being saved
+        if isinstance(self.manager.current_screen, GameScreen):
+            self.manager.current_screen.end_recording("quit")
+        data_io.flush()
+
+        if profiling.ENABLED:
+            print "timings written to " + profiling.export()
+
 
 if __name__ == '__main__':
     ForestDefenders2App().run()
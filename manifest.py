@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import random
+import threading
+
+import config
+import tiles
+import utils
+
+
+# information about a level file, named following the DIFFICULTY_NAME.png convention
+class LevelEntry(object):
+    def __init__(self, directory, filename, rows, cols, hash, mtime, size=None):
+        self.filename = filename
+        self.path = os.path.join(directory, filename)
+        self.rows = rows
+        self.cols = cols
+        # sha1 of the file contents
+        self.hash = hash
+        # modification time and size of the file when it was read, telling whether it changed since
+        self.mtime = mtime
+        self.size = size
+
+        # difficulty and name from the file name, files without a difficulty only appear in free mode
+        stem = os.path.splitext(filename)[0]
+        split = stem.split("_", 1)
+        self.difficulty = split[0] if len(split) == 2 else None
+        self.name = split[-1]
+
+    def to_dict(self):
+        return {"rows": self.rows, "cols": self.cols, "hash": self.hash, "mtime": self.mtime, "size": self.size}
+
+    # reads a level file to create its entry
+    @staticmethod
+    def scan(directory, filename):
+        path = os.path.join(directory, filename)
+        stat = os.stat(path)
+        rows, cols = tiles.image_size(path)
+
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+
+        return LevelEntry(directory, filename, rows, cols, digest.hexdigest(), stat.st_mtime, stat.st_size)
+
+    # returns whether the file changed since it was read
+    def changed(self, stat):
+        return (self.mtime, self.size) != (stat.st_mtime, stat.st_size)
+
+
+# persistent index of the levels in the level directory
+# the files are checked on every refresh, but only new or modified files (by modification time and size) are read
+# queries are answered from memory: the directory is refreshed on the first query of a run, which catches levels
+# modified in place since the previous run, and again whenever its modification time shows files were added or removed
+class LevelManifest(object):
+    def __init__(self, directory, filename):
+        self.directory = directory
+        self.filename = filename
+        # modification time of the directory at the last refresh, None before the first one
+        self.mtime = None
+        # level entries, by file name
+        self.entries = {}
+        # file names of the levels, by difficulty (None for all of them), for constant-time random picks
+        self.by_difficulty = {}
+
+        self._lock = threading.Lock()
+        self._load()
+
+    # loads the manifest saved by a previous run, if there is one
+    def _load(self):
+        if not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename) as f:
+                saved = json.load(f)
+        except ValueError:
+            return
+
+        if saved.get("directory") == self.directory:
+            self.entries = dict((f, LevelEntry(self.directory, f, e["rows"], e["cols"], e["hash"], e["mtime"],
+                                               e.get("size")))
+                                for f, e in saved["levels"].items())
+            self._index()
+
+    # saves the manifest
+    def _save(self):
+        saved = {"directory": self.directory, "levels": dict((f, e.to_dict()) for f, e in self.entries.items())}
+        utils.write_atomic(self.filename, lambda f: json.dump(saved, f, indent=1, sort_keys=True))
+
+    # rebuilds the per-difficulty lists of levels
+    def _index(self):
+        files = sorted(self.entries)
+        self.by_difficulty = {None: files}
+        for f in files:
+            if self.entries[f].difficulty is not None:
+                self.by_difficulty.setdefault(self.entries[f].difficulty, []).append(f)
+
+    # updates the manifest with the levels added, removed or modified since it was last indexed
+    # levels overwritten in place don't change the modification time of the directory, so every file is checked
+    def refresh(self):
+        with self._lock:
+            if not os.path.exists(self.directory):
+                self.mtime = None
+                self.entries = {}
+                self._index()
+                return
+
+            self.mtime = os.path.getmtime(self.directory)
+            entries = {}
+            scanned = False
+            for f in os.listdir(self.directory):
+                path = os.path.join(self.directory, f)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if not os.path.isfile(path):
+                    continue
+
+                entry = self.entries.get(f)
+                if entry is None or entry.changed(stat):
+                    try:
+                        entry = LevelEntry.scan(self.directory, f)
+                    except (IOError, ValueError):
+                        # not a readable image, so not a level
+                        continue
+                    scanned = True
+                entries[f] = entry
+
+            if scanned or len(entries) != len(self.entries):
+                self.entries = entries
+                self._index()
+                self._save()
+
+    # refreshes the manifest before a query, if it was never refreshed or files were added or removed since
+    def _update(self):
+        try:
+            mtime = os.path.getmtime(self.directory)
+        except OSError:
+            mtime = None
+        if self.mtime is None or mtime != self.mtime:
+            self.refresh()
+
+    # returns the entry of the level at the given path, or None if it isn't in the manifest
+    def entry(self, path):
+        self._update()
+        entry = self.entries.get(os.path.basename(path))
+        return entry if entry and os.path.normpath(entry.path) == os.path.normpath(path) else None
+
+    # returns the path of a random level (of the given difficulty if there is one), or None if there are no levels
+    def random_level(self, difficulty=None):
+        self._update()
+        files = self.by_difficulty.get(difficulty)
+        return self.entries[random.choice(files)].path if files else None
+
+    # returns the paths of the levels of the given difficulty, sorted by file name
+    # - "level_list" allows for obtaining only a specific set of levels, by name (e.g. "map2") or file name
+    def levels(self, difficulty, level_list=None):
+        self._update()
+        entries = [self.entries[f] for f in self.by_difficulty.get(difficulty, [])]
+        return [e.path for e in entries if level_list is None or e.name in level_list or e.filename in level_list]
+
+
+# manifest of the level directory, shared across the whole application
+MANIFEST = LevelManifest(config.level_directory, config.level_manifest)
@@ -0,0 +1,395 @@
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from PIL import Image
+import tempfile
+
+import config
+import profiling
+
+
+# whole-array engine used by the map to compare fragments against its pixels and label them
+# every function here works on full numpy arrays, without iterating over pixels in python,
+# and does not depend on kivy so it can be used outside of the game
+
+# classes of the fragment pixels, as stored in fragment class maps and in map label planes
+# (IGNORE corresponds to unlabeled pixels in label planes)
+IGNORE = 0
+FOREST = 1
+NOT_FOREST = 2
+
+
+# per-pixel labels of a map, stored next to its untouched pixels
+class LabelPlane(object):
+    def __init__(self, rows, cols):
+        self.rows = rows
+        self.cols = cols
+        self.size = rows * cols
+
+        # uint8 class of every map pixel
+        self.data = np.zeros((rows, cols), dtype=np.uint8)
+        # running pixel count of every class, indexed by class
+        self.counts = [self.size, 0, 0]
+
+    # number of pixels that have been labeled
+    @property
+    def labeled(self):
+        return self.size - self.counts[IGNORE]
+
+    # returns the labels of a (top, bottom, left, right) region, keeping one pixel every "step" pixels
+    def region(self, rect, step=1):
+        top, bottom, left, right = rect
+        return self.data[top:bottom:step, left:right:step]
+
+    # writes back the labels of a region obtained through "region" after modifying them
+    # regions are views of the plane here, so there is nothing to do
+    def store(self, rect, region):
+        pass
+
+    # labels the given (top, bottom, left, right) region of the plane with the fragment classes
+    # - "fragment" is the fragment class map aligned with the region
+    # - "selected" is the boolean matrix of pixels to label, obtained through "compare"
+    def apply(self, rect, fragment, selected):
+        region = self.region(rect)
+        classes = fragment[selected]
+        region[selected] = classes
+        self.store(rect, region)
+
+        # labels only ever replace unlabeled pixels
+        added = np.bincount(classes, minlength=len(self.counts))
+        self.counts[IGNORE] -= int(added.sum())
+        self.counts[FOREST] += int(added[FOREST])
+        self.counts[NOT_FOREST] += int(added[NOT_FOREST])
+
+
+# returns a boolean matrix of the pixels in an RGB(A) array that are exactly of the given RGB color
+def color_mask(pixels, color):
+    return np.all(pixels[..., :3] == np.asarray(color[:3]), axis=-1)
+
+
+# returns the uint8 class map of a fragment pixel array, according to the fragment example colors
+def classify(pixels):
+    classes = np.zeros(pixels.shape[:2], dtype=np.uint8)
+    classes[color_mask(pixels, config.forest_example)] = FOREST
+    classes[color_mask(pixels, config.not_example)] = NOT_FOREST
+    return classes
+
+
+# returns the RGBA colors used to display labels over the map, indexed by class (unlabeled is transparent)
+def palette():
+    return np.array([(0, 0, 0, 0), tuple(config.forest_example) + (255,), tuple(config.not_example) + (255,)],
+                    dtype=np.uint8)
+
+
+# returns the RGBA overlay displaying the labels of a label plane (or of a region of it)
+def overlay(labels):
+    return palette()[labels]
+
+
+# returns the forest color picked at a map pixel, as the mean color of the pixels around it
+def pick_color(imdata, row, col):
+    around = imdata.region((max(0, row - 2), row + 2, max(0, col - 2), col + 2))
+    return [int(c) for c in np.mean(np.mean(around, axis=0), axis=0)]
+
+
+# returns the map region covered by a fragment, and the part of the fragment's bounding box that lines up with it
+# - "bounds" are the (top, bottom, left, right) map indices covered by the fragment, bottom and right excluded
+# - "origin" is the (row, col) map index that the top-left pixel of the fragment's bounding box corresponds to
+# - "shape" is the (rows, cols) size of the bounding box
+# the region is clipped to the box, both are returned as (top, bottom, left, right) indices
+def overlap(shape, bounds, origin):
+    top, bottom, left, right = bounds
+    bottom = max(top, min(bottom, origin[0] + shape[0]))
+    right = max(left, min(right, origin[1] + shape[1]))
+    return (top, bottom, left, right), (top - origin[0], bottom - origin[0], left - origin[1], right - origin[1])
+
+
+# returns an array for a color field, in a temporary memory-mapped file for large maps
+def _field_array(shape, dtype, large):
+    if large:
+        return np.memmap(tempfile.TemporaryFile(), dtype=dtype, mode="w+", shape=shape)
+    return np.zeros(shape, dtype=dtype)
+
+
+# returns the distances of an array of RGB(A) colors to an RGB color, in the metric of config.color_metric:
+# - "l1" sums the differences of the channels
+# - "perceptual" is the "redmean" weighted euclidean distance, closer to the differences seen by the eye,
+#   and about equal to the L1 distance between shades of grey (so that config.forest_threshold means the same in both)
+def color_distance(colors, color):
+    # signed integers avoid wrapping around with uint8 colors
+    dif = colors[..., :3].astype(np.int32) - np.asarray(color[:3], dtype=np.int32)
+    if config.color_metric == "l1":
+        return np.abs(dif).sum(axis=-1)
+
+    mean = (colors[..., 0].astype(np.float32) + color[0]) / 2
+    squares = (dif * dif).astype(np.float32)
+    return np.rint(np.sqrt((2 + mean / 256) * squares[..., 0] + 4 * squares[..., 1]
+                           + (2 + (255 - mean) / 256) * squares[..., 2])).astype(np.int32)
+
+
+# distance of every map pixel to the forest color, computed once when the color is picked
+# - "distance" is the uint16 distance of every pixel to the color (see color_distance)
+# - "off" is the bitmap of the pixels too far from it to be forest (above config.forest_threshold)
+# - "integral" is the summed-area table of "off", giving the number of off pixels of any rectangle in 4 lookups,
+#   in 64-bit integers for maps of 2^32 pixels or more
+# the map is read one band of rows at a time, and the field of large maps is kept in temporary memory-mapped files
+# for maps with a palette (see palette.py), distances are computed once per palette color and looked up per pixel
+class ColorField(object):
+    def __init__(self, imdata, forest):
+        self.color = [int(c) for c in forest]
+        self.rows = imdata.rows
+        self.cols = imdata.cols
+
+        large = max(self.rows, self.cols) > config.tile_threshold
+        self.distance = _field_array((self.rows, self.cols), np.uint16, large)
+        self.off = _field_array((self.rows, self.cols), np.bool_, large)
+        counts = np.uint64 if self.rows * self.cols >= 1 << 32 else np.uint32
+        self.integral = _field_array((self.rows + 1, self.cols + 1), counts, large)
+
+        table = imdata.distances(self.color) if hasattr(imdata, "distances") else None
+        if table is not None:
+            off_table = table > config.forest_threshold
+            table = table.astype(np.uint16)
+
+        band = max(1, (1 << 22) // max(1, self.cols))
+        for top in xrange(0, self.rows, band):
+            bottom = min(self.rows, top + band)
+            if table is not None:
+                indices = imdata.indices[top:bottom]
+                distance = table[indices]
+                off = off_table[indices]
+            else:
+                distance = color_distance(imdata.region((top, bottom, 0, self.cols)), self.color)
+                off = distance > config.forest_threshold
+
+            self.distance[top:bottom] = distance
+            self.off[top:bottom] = off
+            # the table continues from the last row of the previous band
+            self.integral[top + 1:bottom + 1, 1:] = (np.cumsum(np.cumsum(off, axis=1, dtype=counts), axis=0)
+                                                     + self.integral[top, 1:])
+
+    # returns the off bitmap of a (top, bottom, left, right) region
+    def region(self, rect, step=1):
+        top, bottom, left, right = rect
+        return self.off[top:bottom:step, left:right:step]
+
+    # returns the number of off pixels in a (top, bottom, left, right) region
+    def off_count(self, rect):
+        top, bottom, left, right = rect
+        table = self.integral
+        return int(table[bottom, right]) - int(table[top, right]) - int(table[bottom, left]) + int(table[top, left])
+
+
+# compares a fragment to the map region underneath it
+# - "forest" is the ColorField of the target color for forests (or the RGB target color itself)
+# - "region" and "plane" are the field's off bitmap (or the map pixels) and labels of the region obtained through "overlap"
+# - "fragment" is the fragment class map aligned with the region
+# returns a tuple containing:
+# - the boolean matrix of map pixels the fragment would label
+# - the number of "off" pixels, labeled as forest but too far from the target color
+# - the number of pixels that would be labeled
+def compare(forest, region, plane, fragment):
+    # ignore pixels that have already been previously labeled
+    unlabeled = plane == IGNORE
+
+    # classes of the fragment pixels, anything outside both classes is ignored
+    is_forest = (fragment == FOREST) & unlabeled
+    labels = (fragment != IGNORE) & unlabeled
+
+    # consider the pixel "potentially wrong" if it's above the threshold
+    if isinstance(forest, ColorField):
+        off = int(np.count_nonzero(region & is_forest))
+    else:
+        off = int(np.count_nonzero(color_distance(region[is_forest], forest) > config.forest_threshold))
+    progress = int(np.count_nonzero(labels))
+
+    return labels, off, progress
+
+
+# thread pool used for band-parallel comparisons, created on first use, and its number of workers
+_pool = None
+_pool_workers = 0
+
+
+# returns a thread pool with the given number of workers, reusing the previous one if possible
+def pool(workers):
+    global _pool, _pool_workers
+    if _pool is None or _pool_workers != workers:
+        if _pool is not None:
+            _pool.close()
+        _pool = ThreadPool(workers)
+        _pool_workers = workers
+    return _pool
+
+
+# same as "compare", with the region split into bands of rows compared on several threads
+# numpy releases the GIL in the comparison kernels, so bands run in parallel,
+# and the merged results are identical to those of "compare"
+def compare_bands(forest, region, plane, fragment, workers):
+    edges = np.linspace(0, region.shape[0], workers + 1).astype(int)
+    bands = [(top, bottom) for top, bottom in zip(edges[:-1], edges[1:]) if bottom > top]
+
+    def band(rows):
+        top, bottom = rows
+        return compare(forest, region[top:bottom], plane[top:bottom], fragment[top:bottom])
+
+    results = pool(workers).map(band, bands)
+    if not results:
+        return compare(forest, region, plane, fragment)
+
+    labels = np.concatenate([r[0] for r in results])
+    return labels, sum(r[1] for r in results), sum(r[2] for r in results)
+
+
+# returns the scale of a fragment scatter, in map pixels per fragment pixel
+# - "rotation" is the scatter rotation, counter-clockwise in degrees
+# - "shape" is the (rows, cols) size of the scatter bounding box in map pixels, which the rotated fragment fills
+# a scatter scales both directions alike, so a single scale is fitted to both sides of the box,
+# which only differ by the rounding of the box to whole pixels
+def scatter_scale(fragment_shape, rotation, shape):
+    rows, cols = fragment_shape
+    angle = np.radians(rotation)
+    cos, sin = abs(np.cos(angle)), abs(np.sin(angle))
+    extent = (cols * sin + rows * cos) + (cols * cos + rows * sin)
+    return (shape[0] + shape[1]) / max(1e-9, extent)
+
+
+# returns the affine transform of a fragment scatter, from the (row, col) pixels of its bounding box on the map
+# to the (row, col) pixels of the fragment, as a 2x2 matrix and an offset
+# - the inputs are those of "scatter_scale"
+def scatter_matrix(fragment_shape, rotation, shape):
+    rows, cols = fragment_shape
+    angle = np.radians(rotation)
+    cos, sin = np.cos(angle), np.sin(angle)
+    scale = scatter_scale(fragment_shape, rotation, shape)
+
+    # rows go down while the rotation is counter-clockwise on screen, hence the signs
+    matrix = np.array([[cos, sin],
+                       [-sin, cos]]) / scale
+    # pixel centers of both arrays are aligned on the centers of the box and of the fragment
+    offset = (np.array([rows, cols]) - 1) / 2.0 - matrix.dot((np.array(shape) - 1) / 2.0)
+    return matrix, offset
+
+
+# returns the pixels of a fragment class map rotated and resized to fill a (rows, cols) bounding box,
+# sampled in a single nearest-neighbor pass, the corners uncovered by the rotation being ignored
+# - "window" is the (top, bottom, left, right) part of the box to sample, the whole box if not given:
+#   only its pixels are mapped back to the fragment, straight into the returned array
+def transform(fragment, rotation, shape, window=None):
+    top, bottom, left, right = window or (0, shape[0], 0, shape[1])
+    if bottom <= top or right <= left:
+        return np.zeros((max(0, bottom - top), max(0, right - left)), dtype=np.uint8)
+
+    matrix, offset = scatter_matrix(fragment.shape, rotation, shape)
+    # the first pixel sampled is the (top, left) pixel of the box
+    offset = offset + matrix.dot([top, left])
+    # PIL works on continuous (x, y) coordinates, pixel centers being at half-integers
+    offset = offset + 0.5 - matrix.dot([0.5, 0.5])
+    image = Image.fromarray(np.ascontiguousarray(fragment, dtype=np.uint8))
+    image = image.transform((right - left, bottom - top), Image.AFFINE,
+                            (matrix[1, 1], matrix[1, 0], offset[1], matrix[0, 1], matrix[0, 0], offset[0]),
+                            resample=Image.NEAREST, fillcolor=IGNORE)
+    return np.asarray(image)
+
+
+# returns the share of the pixels of a fragment's bounding box that are forest once the fragment is transformed,
+# from the forest pixels of the fragment itself and the scale of the transform
+# - the inputs are those of "scatter_scale"
+def forest_share(fragment, rotation, shape):
+    scale = scatter_scale(fragment.shape, rotation, shape)
+    forest = np.count_nonzero(fragment == FOREST) * scale * scale
+    return min(1.0, forest / float(max(1, shape[0] * shape[1])))
+
+
+# returns where a fragment lies on the map, without sampling it
+# - "imdata" is the map ImageArray (or anything with its size, such as its ColorField)
+# - the other inputs are the normalized coordinates of "mask"
+# returns the (top, bottom, left, right) region of the map covered by the fragment, the part of the fragment's
+# bounding box that lines up with it, the (rows, cols) size of that box, and the number of map pixels
+# within the fragment's bounds
+def locate(imdata, x, y, right, top):
+    # convert the bound (0-1) normalized coords to the size that corresponds in the map pixel data
+    local_x = int(max(0.0, x) * imdata.cols)
+    local_y = int((1.0 - max(0.0, y)) * imdata.rows)
+    local_right = int(min(1.0, right) * imdata.cols)
+    local_top = int((1.0 - min(1.0, top)) * imdata.rows)
+
+    # alternate coords that are not bounded, required for handling intersecting fragments
+    local_x_unbounded = int(x * imdata.cols)
+    local_top_unbounded = int((1.0 - top) * imdata.rows)
+
+    # (rows, cols) size of the fragment's bounding box in map pixels, to transform the fragment to
+    shape = (max(1, int((1.0 - y) * imdata.rows) - local_top_unbounded),
+             max(1, int(right * imdata.cols) - local_x_unbounded))
+
+    # map region and fragment pixels "underneath" each other
+    rect, window = overlap(shape,
+                           bounds=(local_top, local_y - 1, local_x, local_right - 1),
+                           origin=(local_top_unbounded, local_x_unbounded))
+
+    # total fragment size
+    total = (local_right - local_x) * (local_y - local_top)
+    return rect, window, shape, total
+
+
+# places a fragment on the map
+# - the inputs are those of "mask"
+# returns the (top, bottom, left, right) region of the map covered by the fragment, the fragment class map
+# aligned with it, and the number of map pixels within the fragment's bounds
+def place(imdata, fragment, rotation, x, y, right, top):
+    rect, window, shape, total = locate(imdata, x, y, right, top)
+
+    # rotate and resize the fragment according to the scatter parameters, only where it covers the map
+    with profiling.span("mask: transform"):
+        frag = transform(fragment, rotation, shape, window)
+    return rect, frag, total
+
+
+# compares a fragment to the map and labels the map accordingly
+# - "imdata" is the map ImageArray (left untouched), and "labels" its LabelPlane, modified if the fragment is valid
+# - "forest" is the ColorField of our color target for forests (or the RGB color itself, which is slower)
+# - "fragment" is the fragment class map (see "classify"), and "rotation" its rotation in degrees
+# - the other inputs are the normalized coordinates of the fragment on the map (0-1, from the bottom-left)
+# returns whether the fragment was valid, the number of labeled pixels,
+# and the (top, bottom, left, right) region of the map that was labeled (None if invalid)
+@profiling.timed("mask")
+def mask(imdata, labels, forest, fragment, rotation, x, y, right, top):
+    rect, frag, total = place(imdata, fragment, rotation, x, y, right, top)
+    region = forest.region(rect) if isinstance(forest, ColorField) else imdata.region(rect)
+    plane = labels.region(rect)
+
+    # compare the whole region at once, split across several threads for large regions
+    with profiling.span("mask: compare"):
+        if config.mask_workers > 1 and frag.size >= config.mask_parallel_threshold:
+            selected, off, progress = compare_bands(forest, region, plane, frag, config.mask_workers)
+        else:
+            selected, off, progress = compare(forest, region, plane, frag)
+
+    profiling.count("mask: pixels", total)
+    profiling.count("mask: off pixels", off)
+
+    # fragment is valid if there are more "correct" pixels than the validation rate
+    valid = (total - off) / (total * 1.0) >= config.forest_validation_rate
+
+    # applies the mask if the fragment is validated
+    if not valid:
+        return False, progress, None
+
+    labels.apply(rect, frag, selected)
+    return True, progress, rect
+
+
+# estimates whether a fragment would be valid, without comparing it to the map pixel by pixel
+# the number of off pixels within the fragment's bounds is read from the ColorField's summed-area table,
+# and scaled by the share of forest pixels in the fragment to account for its shape
+# pixels that are already labeled are counted too, so the estimate errs on the side of invalid
+# the fragment is never sampled, so the estimate takes the same time whatever its size on the map
+# - "field" is the ColorField of the forest color, the other inputs are those of "mask"
+# returns whether the fragment is expected to be valid, and the expected share of valid pixels
+def estimate(field, fragment, rotation, x, y, right, top):
+    rect, window, shape, total = locate(field, x, y, right, top)
+    if total <= 0 or rect[1] <= rect[0] or rect[3] <= rect[2]:
+        return False, 0.0
+
+    share = forest_share(fragment, rotation, shape)
+    ratio = (total - field.off_count(rect) * share) / float(total)
+    return ratio >= config.forest_validation_rate, ratio
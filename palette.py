@@ -0,0 +1,94 @@
+import hashlib
+import os
+
+import numpy as np
+
+import config
+import masking
+import profiling
+import utils
+
+
+# maps stored as a table of their distinct colors and the index of every pixel's color in it
+# most maps have far fewer distinct colors than pixels: a uint8 or uint16 index plane takes a quarter or half of
+# the memory of RGBA pixels, and color distances are computed once per palette color (see masking.ColorField)
+# maps with more than config.palette_max_colors colors are quantized, dropping low bits of every channel until they fit
+
+
+# map pixels as a palette index plane and its color table, with the interface of the map ImageArray
+# - "indices" is the (rows, cols) uint8 or uint16 index plane
+# - "colors" is the (n, 4) uint8 RGBA color table
+class PaletteImage(object):
+    def __init__(self, indices, colors):
+        self.indices = indices
+        self.colors = colors
+        self.rows, self.cols = indices.shape
+        self.size = self.rows * self.cols
+
+    # returns the RGBA pixels of a (top, bottom, left, right) region
+    def region(self, rect, step=1):
+        top, bottom, left, right = rect
+        return self.colors[self.indices[top:bottom:step, left:right:step]]
+
+    # returns the RGBA pixels of the whole map
+    def pixels(self):
+        return self.colors[self.indices]
+
+    # returns the distance of every palette color to an RGB color, in the configured metric
+    def distances(self, color):
+        return masking.color_distance(self.colors, color)
+
+    # number of bytes taken by the map
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.colors.nbytes
+
+
+# returns the PaletteImage of RGB or RGBA pixels
+@profiling.timed("quantize")
+def quantize(pixels, max_colors=None):
+    max_colors = max_colors or config.palette_max_colors
+    rows, cols = pixels.shape[:2]
+    rgba = np.empty((rows, cols, 4), dtype=np.uint8)
+    rgba[..., :pixels.shape[2]] = pixels
+    if pixels.shape[2] == 3:
+        rgba[..., 3] = 255
+    # every pixel as a single integer, so that colors can be told apart with a single sort
+    packed = rgba.view(np.uint32).reshape(rows, cols)
+
+    for bits in xrange(8, 0, -1):
+        drop = 8 - bits
+        keep = np.uint32(((0xff >> drop) << drop) * 0x01010101)
+        values, inverse = np.unique(packed & keep, return_inverse=True)
+        if len(values) <= max_colors:
+            break
+
+    indices = inverse.reshape(rows, cols).astype(np.uint8 if len(values) <= 256 else np.uint16)
+    if drop == 0:
+        colors = values.view(np.uint8).reshape(-1, 4)
+    else:
+        # quantized colors are the average of the pixels they replace
+        counts = np.bincount(inverse, minlength=len(values)).astype(np.float64)
+        colors = np.empty((len(values), 4), dtype=np.uint8)
+        for c in xrange(4):
+            sums = np.bincount(inverse, weights=rgba[..., c].ravel(), minlength=len(values))
+            colors[:, c] = np.round(sums / counts)
+    return PaletteImage(indices, colors)
+
+
+# returns the PaletteImage of a level, read from the disk cache if it was already computed
+# - "level_hash" identifies the contents of the level, nothing is cached if it isn't known
+# - "load" returns the pixels of the level, called only if they have to be quantized
+def load(load, level_hash):
+    if level_hash is None:
+        return quantize(load())
+
+    key = "%s:%d" % (level_hash, config.palette_max_colors)
+    path = os.path.join(config.palette_directory, hashlib.sha1(key).hexdigest() + ".npz")
+    if os.path.exists(path):
+        with np.load(path) as archive:
+            return PaletteImage(archive["indices"], archive["colors"])
+
+    image = quantize(load())
+    utils.write_atomic(path, lambda f: np.savez(f, indices=image.indices, colors=image.colors))
+    return image
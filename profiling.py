@@ -0,0 +1,154 @@
+import collections
+import functools
+import json
+import os
+import threading
+import time
+
+import config
+
+
+# lightweight instrumentation of the hot paths, enabled with config.profiling
+# timed functions and spans are recorded as trace events in the chrome trace format
+# (which chrome://tracing and https://ui.perfetto.dev can open), and summarized per name for the on-screen overlay
+# when profiling is disabled, "timed" returns functions unchanged and "span" returns a shared no-op context,
+# so that instrumented code runs as if it wasn't
+
+
+ENABLED = config.profiling
+
+# time at which recording started, trace timestamps being relative to it
+_origin = time.time()
+# most recent trace events, older ones being dropped once the limit is reached
+_events = collections.deque(maxlen=config.trace_max_events)
+# summary of the durations recorded under every name
+_stats = {}
+_lock = threading.Lock()
+# phases of the startup, as (name, duration in seconds) in order, recorded whether profiling is enabled or not
+_phases = []
+# time at which the current startup phase started
+_phase_start = _origin
+
+
+# summary of the durations recorded under a name, in seconds
+class Stat(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.last = duration
+        self.max = max(self.max, duration)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+# records a duration under the given name
+# - "start" is the time.time() at which it started
+def record(name, start, duration):
+    _events.append({"name": name, "ph": "X", "pid": os.getpid(), "tid": threading.current_thread().ident,
+                    "ts": (start - _origin) * 1e6, "dur": duration * 1e6})
+    with _lock:
+        stat = _stats.get(name)
+        if stat is None:
+            stat = _stats[name] = Stat()
+        stat.add(duration)
+
+
+# records the value of a counter (for example the number of pixels of a validation)
+def count(name, value):
+    if ENABLED:
+        _events.append({"name": name, "ph": "C", "pid": os.getpid(), "ts": (time.time() - _origin) * 1e6,
+                        "args": {name: value}})
+
+
+# decorator recording the duration of every call to a function under the given name
+def timed(name):
+    def decorator(function):
+        if not ENABLED:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, start, time.time() - start)
+        return wrapper
+    return decorator
+
+
+# context recording the duration of a block of code
+class _Span(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc):
+        record(self.name, self.start, time.time() - self.start)
+
+
+# context used in place of spans when profiling is disabled
+class _NoSpan(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+# returns a context recording the duration of the code it surrounds under the given name
+def span(name):
+    return _Span(name) if ENABLED else _NO_SPAN
+
+
+# marks the end of a startup phase, which started at the end of the previous one
+# - "start" is the time.time() at which the phase started, if it isn't the end of the previous one
+def startup_phase(name, start=None):
+    global _phase_start
+    now = time.time()
+    start = _phase_start if start is None else start
+    _phases.append((name, now - start))
+    if ENABLED:
+        record("startup: " + name, start, now - start)
+    _phase_start = now
+
+
+# returns the report of the startup phases recorded so far, one line per phase
+def startup_report():
+    lines = []
+    elapsed = 0.0
+    for name, duration in _phases:
+        elapsed += duration
+        lines.append("%-24s %8.1f ms %8.1f ms" % (name, duration * 1000, elapsed * 1000))
+    return "\n".join(["%-24s %11s %11s" % ("startup phase", "duration", "elapsed")] + lines)
+
+
+# returns a copy of the summaries of the recorded durations, by name
+def stats():
+    with _lock:
+        copies = {}
+        for name, stat in _stats.items():
+            copy = copies[name] = Stat()
+            copy.__dict__.update(stat.__dict__)
+        return copies
+
+
+# writes the recorded trace events to a file (config.trace_file if not given), and returns its path
+def export(path=None):
+    path = path or config.trace_file
+    with open(path, "w") as f:
+        json.dump({"traceEvents": list(_events), "displayTimeUnit": "ms"}, f)
+    return path
@@ -0,0 +1,60 @@
+import gzip
+import json
+import os
+import time
+
+import config
+import utils
+
+
+# recordings are gzip-compressed json lines, one event per line
+# every event has a "type" and a time "t" in seconds since the start of the game:
+# - "start": level "source", "hash", "rows", "cols" and the starting "time"
+# - "color": forest "color" picked at the map pixel ("row", "col")
+# - "fragment": "fragment" file selected
+# - "validate": "fragment" file, scatter "rotation", "scale" and "pos", normalized map "coords" of the fragment,
+#   and the result: "valid", "progress" and the "seconds" spent validating
+# - "cancel": fragment put back without being validated
+# - "end": "outcome" of the game ("win", "lose" or "quit") and label "counts" of the map
+
+
+# converts the numpy values found in events into their python equivalent
+def _plain(value):
+    return value.item() if hasattr(value, "item") else value.tolist()
+
+
+# recording of a single game, kept in memory and written once the game is over
+class Recording(object):
+    def __init__(self, source, rows, cols, hash=None):
+        self.start = time.time()
+        self.events = []
+        self.path = os.path.join(config.recording_directory, "%s_%d.jsonl.gz" % (
+            os.path.splitext(os.path.basename(source))[0], self.start * 1000))
+        self.record("start", source=source, hash=hash, rows=rows, cols=cols, time=self.start)
+
+    # adds an event to the recording
+    def record(self, type, **fields):
+        fields["type"] = type
+        fields["t"] = round(time.time() - self.start, 4)
+        self.events.append(fields)
+
+    # adds the end event and writes the recording
+    def close(self, outcome, counts):
+        self.record("end", outcome=outcome, counts=[int(c) for c in counts])
+
+        utils.write_atomic(self.path, self._write)
+
+    # writes the events, compressed, to an open file
+    def _write(self, f):
+        with gzip.GzipFile(fileobj=f, mode="wb") as compressed:
+            for event in self.events:
+                compressed.write(json.dumps(event, default=_plain, sort_keys=True) + "\n")
+
+
+# loads the events of a recording file
+def load(path):
+    f = gzip.open(path, "rb")
+    try:
+        return [json.loads(line) for line in f if line.strip()]
+    finally:
+        f.close()
@@ -0,0 +1,130 @@
+# Headless replay of recorded games (see recording.py), without kivy
+# Runs the color picks and fragment validations of every recording against the map again, as fast as possible,
+# reports any difference with the recorded results and the time spent validating,
+# and prints a digest of the final labels, so that two versions of the engine can be checked to label identically
+#
+# usage: python replay.py RECORDING [RECORDING ...] [--repeat N] [--save-labels DIR]
+
+import argparse
+import hashlib
+import os
+import time
+
+from scipy import misc
+
+import config
+import manifest
+import masking
+import palette
+import recording
+import results
+import tiles
+
+
+# map pixels of a level small enough to be loaded at once, with the interface used by the engine
+class MapPixels(object):
+    def __init__(self, data):
+        self.data = data
+        self.rows, self.cols = data.shape[:2]
+        self.size = self.rows * self.cols
+
+    def region(self, rect, step=1):
+        top, bottom, left, right = rect
+        return self.data[top:bottom:step, left:right:step]
+
+
+# loads the map pixels of a level, the same way the game does
+def load_level(source):
+    if tiles.is_large(source):
+        return tiles.open_level(source, offline=True)
+    if config.palette_levels:
+        entry = manifest.MANIFEST.entry(source)
+        return palette.load(lambda: misc.imread(source), entry.hash if entry else None)
+    return MapPixels(misc.imread(source))
+
+
+# returns an empty label plane for the map pixels of a level
+def new_labels(imdata):
+    if isinstance(imdata, tiles.TiledImage):
+        return tiles.TiledLabelPlane(imdata.rows, imdata.cols)
+    return masking.LabelPlane(imdata.rows, imdata.cols)
+
+
+# returns the sha1 of a label plane, computed from its runs so that tiled planes are never loaded at once
+def digest(labels):
+    values, lengths = results.encode(labels)
+    return hashlib.sha1(values.tostring() + lengths.tostring()).hexdigest()
+
+
+# replays the events of a recording on a new label plane
+# returns the label plane, the list of differences with the recording, and the validation times in seconds
+def replay(events, imdata):
+    labels = new_labels(imdata)
+    differences = []
+    times = []
+    # ColorField of the picked forest color
+    forest = None
+    fragments = {}
+
+    for i, event in enumerate(events):
+        if event["type"] == "color":
+            color = masking.pick_color(imdata, event["row"], event["col"])
+            if color != event["color"]:
+                differences.append("event %d: color %s, recorded %s" % (i, color, event["color"]))
+            forest = masking.ColorField(imdata, color)
+
+        elif event["type"] == "validate":
+            path = event["fragment"]
+            if path not in fragments:
+                fragments[path] = masking.classify(misc.imread(path))
+
+            start = time.time()
+            valid, progress, rect = masking.mask(imdata, labels, forest, fragments[path], event["rotation"],
+                                                 *event["coords"])
+            times.append(time.time() - start)
+            if (valid, progress) != (event["valid"], event["progress"]):
+                differences.append("event %d: valid %s with %d pixels, recorded %s with %d pixels" % (
+                    i, valid, progress, event["valid"], event["progress"]))
+
+        elif event["type"] == "end":
+            counts = [int(c) for c in labels.counts]
+            if counts != event["counts"]:
+                differences.append("end: label counts %s, recorded %s" % (counts, event["counts"]))
+
+    return labels, differences, times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Headless replay of recorded Forest Defenders 2 games")
+    parser.add_argument("recordings", nargs="+", help="recording files (see recording.py)")
+    parser.add_argument("--repeat", type=int, default=1, help="number of times to replay every recording")
+    parser.add_argument("--save-labels", metavar="DIR", help="directory in which to save the final labels")
+    options = parser.parse_args()
+
+    failed = False
+    for path in options.recordings:
+        events = recording.load(path)
+        start = events[0]
+        entry = manifest.MANIFEST.entry(start["source"])
+        if start.get("hash") and entry and entry.hash != start["hash"]:
+            print "%s: the level has changed since it was recorded" % path
+
+        imdata = load_level(start["source"])
+        for r in xrange(options.repeat):
+            labels, differences, times = replay(events, imdata)
+        recorded = [e["seconds"] for e in events if e["type"] == "validate"]
+
+        print "%s: %s, %d validations in %.3fs (slowest %.3fs, recorded %.3fs), labels %s" % (
+            path, start["source"], len(times), sum(times), max(times or [0]), sum(recorded), digest(labels))
+        for difference in differences:
+            print "  " + difference
+        failed = failed or bool(differences)
+
+        if options.save_labels:
+            name = os.path.basename(path).split(".")[0]
+            results.save(os.path.join(options.save_labels, name + "_labels.npz"), labels,
+                         {"level": name, "source": start["source"], "hash": start.get("hash"),
+                          "rows": labels.rows, "cols": labels.cols})
+
+    if failed:
+        raise SystemExit(1)
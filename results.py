@@ -0,0 +1,109 @@
+import json
+import numpy as np
+import Queue
+import threading
+import traceback
+
+import config
+import utils
+
+
+# results are stored as run-length-encoded label planes, in compressed ".npz" files
+# runs go through the plane in row-major order: "values" holds the label of each run and "lengths" its length,
+# and "meta" holds the result metadata (level name and hash, size, label counts, ...) as a json string
+FORMAT = 1
+
+
+# run-length-encodes a flat array of labels, returning the values and lengths of its runs
+def _runs(flat):
+    starts = np.concatenate([[0], np.flatnonzero(flat[1:] != flat[:-1]) + 1])
+    return flat[starts], np.diff(np.concatenate([starts, [flat.size]]))
+
+
+# run-length-encodes a LabelPlane, returning the values and lengths of its runs
+# the plane is read one band of rows at a time, so that tiled planes are never loaded all at once
+def encode(labels):
+    band = max(1, (1 << 22) // max(1, labels.cols))
+    values, lengths = [], []
+    for top in xrange(0, labels.rows, band):
+        v, l = _runs(labels.region((top, min(top + band, labels.rows), 0, labels.cols)).ravel())
+        # the first run of a band continues the last run of the previous one if they have the same label,
+        # uniform bands being merged entirely into it
+        if values and v[0] == values[-1][-1]:
+            lengths[-1][-1] += l[0]
+            v, l = v[1:], l[1:]
+        if len(v):
+            values.append(v)
+            lengths.append(l)
+
+    if not values:
+        return np.zeros(0, np.uint8), np.zeros(0, np.int64)
+    return np.concatenate(values).astype(np.uint8), np.concatenate(lengths).astype(np.int64)
+
+
+# expands runs back into a (rows, cols) array of labels
+def decode(values, lengths, rows, cols):
+    return np.repeat(values, lengths).reshape(rows, cols)
+
+
+# saves the labels of a LabelPlane and the metadata dictionary to a result file
+def save(path, labels, meta):
+    values, lengths = encode(labels)
+    utils.write_atomic(path, lambda f: np.savez_compressed(f, values=values, lengths=lengths,
+                                                           meta=np.array(json.dumps(meta))))
+
+
+# loads the metadata dictionary of a result file, without reading its labels
+def load_meta(path):
+    with np.load(path) as f:
+        return json.loads(str(f["meta"]))
+
+
+# loads a result file without expanding its runs, returning the values and lengths of its runs and its metadata
+def load_runs(path):
+    with np.load(path) as f:
+        return f["values"], f["lengths"], json.loads(str(f["meta"]))
+
+
+# loads a result file, returning its (rows, cols) array of labels and its metadata dictionary
+def load(path):
+    values, lengths, meta = load_runs(path)
+    return decode(values, lengths, meta["rows"], meta["cols"]), meta
+
+
+# writes results on a background thread, so that saving never stalls the game
+class ResultWriter(object):
+    # - "size" is the maximum number of results waiting to be written
+    def __init__(self, size):
+        self._jobs = Queue.Queue(size)
+
+        worker = threading.Thread(target=self._work)
+        worker.daemon = True
+        worker.start()
+
+    # queues a result to be written, waiting for room in the queue if it's full
+    # the LabelPlane must not be modified afterwards, which is the case once a level is over
+    # - "done" is called with the path on the writer thread once the result has been written
+    def put(self, path, labels, meta, done=None):
+        self._jobs.put((path, labels, meta, done))
+
+    # waits until all queued results have been written
+    def flush(self):
+        self._jobs.join()
+
+    # background thread, writing results one after the other
+    def _work(self):
+        while True:
+            path, labels, meta, done = self._jobs.get()
+            try:
+                save(path, labels, meta)
+                if done:
+                    done(path)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self._jobs.task_done()
+
+
+# writer shared across the whole application
+WRITER = ResultWriter(config.result_queue_size)
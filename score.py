@@ -0,0 +1,179 @@
+# Batch scoring of the players' results against reference labels
+# Every result is compared with the reference of its level one chunk of pixels at a time, straight from its runs,
+# and the per-class confusion counts are summed per level and per player, so memory stays flat whatever the number
+# of results. Results are spread across a pool of processes
+#
+# usage: python score.py REFERENCES [--results DIR] [--workers N] [--levels NAME ...] [--csv FILE]
+#
+# references are files of the REFERENCES directory named after their level, either:
+# - NAME.npy or NAME_consensus.npy: class map of the level (see masking.py), such as the maps written by
+#   consensus.py, or a boolean forest mask
+# - NAME.png (or any other image format): forest and not forest pixels in the colors of the fragment examples,
+#   any other color being unknown
+# only the pixels with a known reference are scored: the accuracy is the share of the labeled pixels that are right,
+# while unlabeled pixels count as missed in the IoU of each class
+
+import argparse
+import csv
+import glob
+import multiprocessing
+import os
+
+import numpy as np
+from scipy import misc
+
+import config
+import masking
+import results
+
+
+# number of pixels compared at once
+CHUNK = 1 << 22
+# classes scored, in the order of the confusion matrices
+CLASSES = [("forest", masking.FOREST), ("not forest", masking.NOT_FOREST)]
+
+# reference last loaded by this process, as (path, modification time, flat class map)
+_reference = None
+
+
+# returns the path of the reference of a level, or None if there is none
+# class maps are preferred to images, so the output directory of consensus.py can be used as it is
+def find_reference(directory, level):
+    for name in [level + ".npy", level + "_consensus.npy"]:
+        if os.path.isfile(os.path.join(directory, name)):
+            return os.path.join(directory, name)
+    paths = sorted(glob.glob(os.path.join(directory, level + ".*")))
+    return (paths or [None])[0]
+
+
+# returns the flat class map of a reference, reusing the last one if it hasn't changed
+# class maps are memory-mapped, and results are listed by level so that consecutive results share their reference
+def load_reference(path):
+    global _reference
+    mtime = os.path.getmtime(path)
+    if _reference is None or _reference[:2] != (path, mtime):
+        if path.endswith(".npy"):
+            labels = np.load(path, mmap_mode="r")
+        else:
+            labels = masking.classify(misc.imread(path))
+        _reference = (path, mtime, labels.reshape(-1))
+    return _reference[2]
+
+
+# returns the labels of the pixels from "start" to "stop" of a result, expanded from the runs overlapping them
+# - "ends" is the cumulative sum of the run lengths
+def expand(values, ends, start, stop):
+    first = np.searchsorted(ends, start, side="right")
+    last = min(len(ends), np.searchsorted(ends, stop, side="left") + 1)
+    run_ends = np.minimum(ends[first:last], stop)
+    run_starts = np.maximum(np.concatenate([[0], ends])[first:last], start)
+    return np.repeat(values[first:last], run_ends - run_starts)
+
+
+# scores a result file against the reference of its level
+# returns the path, then (level, player, 3x3 confusion counts of reference class x label) or None,
+# and the reason the result was skipped (None if it wasn't, or if it was left out by "levels")
+def score(job):
+    path, references, levels = job
+    try:
+        values, lengths, meta = results.load_runs(path)
+    except Exception as e:
+        return path, None, "%s: %s" % (type(e).__name__, e)
+
+    level = meta["level"]
+    if levels and level not in levels:
+        return path, None, None
+    reference_path = find_reference(references, level)
+    if reference_path is None:
+        return path, None, "no reference for level " + level
+
+    reference = load_reference(reference_path)
+    size = meta["rows"] * meta["cols"]
+    if reference.size != size or lengths.sum() != size:
+        return path, None, "size does not match the reference of level " + level
+
+    ends = np.cumsum(lengths)
+    confusion = np.zeros(9, np.int64)
+    for start in xrange(0, size, CHUNK):
+        stop = min(size, start + CHUNK)
+        expected = reference[start:stop]
+        if expected.dtype == np.bool_:
+            expected = np.where(expected, masking.FOREST, masking.NOT_FOREST)
+        labels = expand(values, ends, start, stop)
+        confusion += np.bincount(expected.astype(np.intp) * 3 + labels, minlength=9)
+    return path, (level, meta.get("player") or "unknown", confusion.reshape(3, 3)), None
+
+
+# returns the coverage, accuracy and IoU of every class of summed confusion counts (None when undefined)
+def metrics(confusion):
+    known = confusion[[c for n, c in CLASSES]]
+    total = known.sum()
+    labeled = known[:, [c for n, c in CLASSES]].sum()
+    correct = sum(confusion[c, c] for n, c in CLASSES)
+
+    ious = []
+    for name, c in CLASSES:
+        union = confusion[c].sum() + known[:, c].sum() - confusion[c, c]
+        ious.append(confusion[c, c] / float(union) if union else None)
+    return ([labeled / float(total) if total else None, correct / float(labeled) if labeled else None]
+            + ious)
+
+
+# formats a share as a percentage
+def percent(value):
+    return "%.1f%%" % (100 * value) if value is not None else "-"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Scoring of the Forest Defenders 2 results against reference labels")
+    parser.add_argument("references", help="directory containing the reference labels of the levels")
+    parser.add_argument("--results", default=config.result_directory, help="directory containing the result files")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="number of processes")
+    parser.add_argument("--levels", nargs="+", help="names of the levels to score (all of them by default)")
+    parser.add_argument("--csv", metavar="FILE", help="file in which to also write the table, with confusion counts")
+    options = parser.parse_args()
+
+    # result file names start with their level, so sorting them keeps the results of a level together
+    paths = [os.path.join(options.results, f) for f in sorted(os.listdir(options.results)) if f.endswith(".npz")]
+    jobs = ((path, options.references, set(options.levels or [])) for path in paths)
+
+    # confusion counts and number of results, per level and player (None for all players)
+    totals = {}
+    skipped = 0
+    pool = multiprocessing.Pool(options.workers)
+    try:
+        for path, scored, problem in pool.imap_unordered(score, jobs, chunksize=16):
+            if problem:
+                print "skipping %s: %s" % (path, problem)
+                skipped += 1
+            if scored:
+                level, player, confusion = scored
+                for key in [(level, player), (level, None)]:
+                    total = totals.setdefault(key, [0, np.zeros((3, 3), np.int64)])
+                    total[0] += 1
+                    total[1] += confusion
+    finally:
+        pool.close()
+        pool.join()
+
+    header = ["level", "player", "results", "coverage", "accuracy"] + [n + " IoU" for n, c in CLASSES]
+    rows = []
+    # the players of a level, followed by all of them together
+    for (level, player) in sorted(totals, key=lambda k: (k[0], k[1] is None, k[1])):
+        count, confusion = totals[level, player]
+        rows.append([level, player or "(all)", count] + metrics(confusion) + [confusion])
+
+    table = "%-30s %-20s %7s %9s %9s %14s %14s"
+    print table % tuple(header)
+    for row in rows:
+        print table % tuple(row[:3] + [percent(v) for v in row[3:-1]])
+    print "%d result(s) scored, %d skipped" % (sum(r[2] for r in rows if r[1] == "(all)"), skipped)
+
+    if options.csv:
+        with open(options.csv, "wb") as f:
+            writer = csv.writer(f)
+            writer.writerow(header + ["%s as %s" % (n, m) for n, c in CLASSES
+                                      for m in ["unlabeled", "forest", "not forest"]])
+            for row in rows:
+                confusion = row[-1]
+                writer.writerow(row[:-1] + [int(confusion[c, l]) for n, c in CLASSES for l in range(3)])
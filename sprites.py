@@ -0,0 +1,138 @@
+# Texture atlases of the UI sprites and fragment previews, and their runtime loader
+# Packing many small images into a few large textures (in kivy's atlas format) means fewer textures to load at
+# startup and fewer texture switches while drawing. Images missing from the atlases, or changed since they were
+# built, are loaded from their own files as before, so the game runs the same whether the atlases exist or not
+#
+# usage: python sprites.py [--size 1024]
+
+import os
+# kivy would otherwise try to parse the tool's own command-line arguments
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+
+import argparse
+import glob
+import json
+import shutil
+import tempfile
+
+import config
+
+# atlas of the images of the "images" directory
+UI = "ui"
+# atlas of the fragments and of their translucent previews
+FRAGMENTS = "fragments"
+
+
+# key of an image in an atlas, its file name without extension (as given by kivy.atlas)
+def key(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+# key of the translucent preview of a fragment, which depends on the transparency it was built with
+def preview_key(path):
+    return "%s-preview-%d" % (key(path), config.fragment_transparency)
+
+
+# atlas built in config.atlas_directory, its index being read on first use
+class SpriteAtlas(object):
+    def __init__(self, name):
+        self.name = name
+        self.path = os.path.join(config.atlas_directory, name + ".atlas")
+        # keys of the packed images, and modification time of the index
+        self._keys = None
+        self._mtime = None
+        # kivy Atlas, loaded on first use of its textures
+        self._atlas = None
+
+    # reads the index, if the atlas was built
+    def _load_index(self):
+        if self._keys is None:
+            self._keys = set()
+            if os.path.exists(self.path):
+                self._mtime = os.path.getmtime(self.path)
+                with open(self.path) as f:
+                    for page in json.load(f).values():
+                        self._keys.update(page)
+
+    # returns whether an image file is packed in the atlas, and hasn't changed since
+    # - "name" is its key, the key of the file itself if not given
+    def contains(self, path, name=None):
+        self._load_index()
+        return (name or key(path)) in self._keys and os.path.getmtime(path) <= self._mtime
+
+    # returns the "atlas://" url of an image, usable as the source of kivy images
+    def url(self, name):
+        return "atlas://%s/%s" % (os.path.splitext(self.path)[0].replace(os.sep, "/"), name)
+
+    # returns the texture of an image, a region of the atlas texture
+    def texture(self, name):
+        if self._atlas is None:
+            from kivy.atlas import Atlas
+            self._atlas = Atlas(self.path)
+        return self._atlas[name]
+
+
+# atlases shared across the whole application
+ATLASES = {UI: SpriteAtlas(UI), FRAGMENTS: SpriteAtlas(FRAGMENTS)}
+
+
+# returns the source to use for a UI image: its atlas url if it's packed, its path otherwise
+def sprite(path):
+    atlas = ATLASES[UI]
+    return atlas.url(key(path)) if atlas.contains(path) else path
+
+
+# returns the texture of a fragment from the fragment atlas, or None if it isn't packed
+# - "preview" selects its translucent preview instead
+def fragment_texture(path, preview=False):
+    atlas = ATLASES[FRAGMENTS]
+    name = preview_key(path) if preview else key(path)
+    return atlas.texture(name) if atlas.contains(path, name) else None
+
+
+# packs images into an atlas, returns the number of pages
+def build(name, paths, size):
+    from kivy.atlas import Atlas
+
+    if not os.path.exists(config.atlas_directory):
+        os.makedirs(config.atlas_directory)
+    result = Atlas.create(os.path.join(config.atlas_directory, name), paths, size)
+    if not result:
+        raise SystemExit("an image of the %s atlas is larger than %dx%d" % (name, size, size))
+    return len(result[1])
+
+
+# packs the UI images (animations excepted) into the UI atlas
+def build_ui(size):
+    paths = sorted(glob.glob(os.path.join("images", "*.png")))
+    return build(UI, paths, size), len(paths)
+
+
+# packs the fragments and their translucent previews into the fragment atlas
+def build_fragments(size):
+    from scipy import misc
+    import utils
+
+    paths = sorted(p for p in glob.glob(os.path.join(config.fragment_directory, "*")) if os.path.isfile(p))
+    workdir = tempfile.mkdtemp(prefix="fd2_atlas_")
+    try:
+        images = []
+        for path in paths:
+            pixels = misc.imread(path)
+            image = utils.ImageArray(pixels.shape[0], pixels.shape[1], pixels)
+            image.save(os.path.join(workdir, key(path) + ".png"))
+            image[:, :, 3] = config.fragment_transparency
+            image.save(os.path.join(workdir, preview_key(path) + ".png"))
+            images += [os.path.join(workdir, key(path) + ".png"), os.path.join(workdir, preview_key(path) + ".png")]
+        return build(FRAGMENTS, images, size), len(paths)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Builds the texture atlases of Forest Defenders 2")
+    parser.add_argument("--size", type=int, default=config.atlas_size, help="size of the atlas pages, in pixels")
+    options = parser.parse_args()
+
+    print "ui: %d page(s), %d images" % build_ui(options.size)
+    print "fragments: %d page(s), %d fragments" % build_fragments(options.size)
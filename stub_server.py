@@ -0,0 +1,165 @@
+# Local stand-in for the level server used by the http backend (see backends.py), and a load test against it
+#
+# usage: python stub_server.py serve [--port 8000] [--levels DIR] [--results DIR] [--fail-rate 0.1]
+#        python stub_server.py load [--url URL] [--clients 8] [--levels-per-client 20] [--results-per-client 20]
+#
+# protocol:
+# - GET /level answers a random level file, with its file name and sha1 in the X-Level-Name and X-Level-Hash headers
+# - POST /results receives a zip archive of result files (see results.py), stored in the results directory
+
+import argparse
+import BaseHTTPServer
+import hashlib
+import io
+import os
+import random
+import shutil
+import SocketServer
+import tempfile
+import threading
+import time
+import zipfile
+
+import numpy as np
+
+import config
+
+
+# request handler of the stub server, the server options being attributes of the server
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keeps connections open between requests
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/level":
+            return self.answer(404)
+        if self.fail():
+            return
+        levels = [f for f in os.listdir(self.server.levels) if os.path.isfile(os.path.join(self.server.levels, f))]
+        if not levels:
+            return self.answer(404)
+
+        name = random.choice(levels)
+        with open(os.path.join(self.server.levels, name), "rb") as f:
+            data = f.read()
+        self.answer(200, data, {"Content-Type": "application/octet-stream", "X-Level-Name": name,
+                                "X-Level-Hash": hashlib.sha1(data).hexdigest()})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader("content-length", 0)))
+        if self.path.rstrip("/") != "/results":
+            return self.answer(404)
+        if self.fail():
+            return
+
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            for name in archive.namelist():
+                with open(os.path.join(self.server.results, os.path.basename(name)), "wb") as f:
+                    f.write(archive.read(name))
+        self.answer(204)
+
+    # answers a random share of the requests with an error, to exercise retries
+    def fail(self):
+        if random.random() < self.server.fail_rate:
+            self.answer(503)
+            return True
+        return False
+
+    def answer(self, status, data="", headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+# stub server, handling every connection on its own thread
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, levels, results, fail_rate=0.0, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, ("", port), StubHandler)
+        self.levels = levels
+        self.results = results
+        self.fail_rate = fail_rate
+        self.verbose = verbose
+        if not os.path.exists(results):
+            os.makedirs(results)
+
+
+# simulates players: every client obtains levels and saves results through its own http backend,
+# the same way the game does
+# every client has its own download and spool directories, as players have their own machines
+def load_test(url, clients, levels_per_client, results_per_client):
+    import backends
+    import masking
+
+    labels = masking.LabelPlane(256, 256)
+    labels.data[:, :128] = masking.FOREST
+    times = []
+    workdir = tempfile.mkdtemp(prefix="fd2_load_")
+    players = [backends.HTTPBackend(url, os.path.join(workdir, "downloads_%d" % k),
+                                    os.path.join(workdir, "spool_%d" % k)) for k in xrange(clients)]
+
+    def client(k):
+        backend = players[k]
+        start = time.time()
+        for i in xrange(levels_per_client):
+            backend.get_level()
+        for i in xrange(results_per_client):
+            backend.save_result("load_%d_result_%d.npz" % (k, i), labels, {"level": "load", "rows": 256, "cols": 256})
+        backend.flush()
+        times.append(time.time() - start)
+
+    try:
+        start = time.time()
+        threads = [threading.Thread(target=client, args=(k,)) for k in xrange(clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        left = sum(len(os.listdir(b.spool_directory)) for b in players)
+    finally:
+        for backend in players:
+            backend.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print "%d levels obtained, %d results saved in %.2fs" % (clients * levels_per_client,
+                                                            clients * results_per_client, elapsed)
+    print "time per client: %.3fs median, %.3fs max" % (np.median(times), max(times))
+    print "%d result(s) left unsent" % left
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stand-in for the Forest Defenders 2 level server")
+    commands = parser.add_subparsers(dest="command")
+
+    serve = commands.add_parser("serve", help="run the stub server")
+    serve.add_argument("--port", type=int, default=8000, help="port to listen on")
+    serve.add_argument("--levels", default=config.level_directory, help="directory of the levels to serve")
+    serve.add_argument("--results", default="server_results/", help="directory in which to store received results")
+    serve.add_argument("--fail-rate", type=float, default=0.0, help="share of requests answered with an error")
+    serve.add_argument("--verbose", action="store_true", help="log every request")
+
+    load = commands.add_parser("load", help="load-test a running server")
+    load.add_argument("--url", default=config.server_url, help="url of the server")
+    load.add_argument("--clients", type=int, default=8, help="number of simultaneous clients")
+    load.add_argument("--levels-per-client", type=int, default=20, help="levels downloaded by every client")
+    load.add_argument("--results-per-client", type=int, default=20, help="results uploaded by every client")
+    options = parser.parse_args()
+
+    if options.command == "serve":
+        server = StubServer(options.port, options.levels, options.results, options.fail_rate, options.verbose)
+        print "serving %s on port %d" % (options.levels, options.port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    else:
+        load_test(options.url, options.clients, options.levels_per_client, options.results_per_client)
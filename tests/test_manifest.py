@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import manifest
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.levels = os.path.join(self.directory, "levels")
+        os.mkdir(self.levels)
+        self.filename = os.path.join(self.directory, "manifest.json")
+        for name, shape in [("easy_map1.npy", (10, 20)), ("easy_map2.npy", (30, 40)), ("hard_map3.npy", (5, 5)),
+                            ("free.npy", (8, 8))]:
+            np.save(os.path.join(self.levels, name), np.zeros(shape + (3,), np.uint8))
+        # not a level
+        with open(os.path.join(self.levels, "notes.txt"), "w") as f:
+            f.write("notes")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.levels, name)
+
+    def test_lookup(self):
+        levels = manifest.LevelManifest(self.levels, self.filename)
+        entry = levels.entry(self.path("easy_map2.npy"))
+        self.assertEqual((entry.rows, entry.cols, entry.difficulty, entry.name), (30, 40, "easy", "map2"))
+        self.assertIsNone(levels.entry(self.path("notes.txt")))
+        self.assertIsNone(levels.entry(os.path.join(self.directory, "easy_map2.npy")))
+
+        self.assertEqual(levels.levels("easy"), [self.path("easy_map1.npy"), self.path("easy_map2.npy")])
+        self.assertEqual(levels.levels("easy", ["map2"]), [self.path("easy_map2.npy")])
+        self.assertEqual(levels.levels("medium"), [])
+
+    def test_random_choice(self):
+        levels = manifest.LevelManifest(self.levels, self.filename)
+        picked = set(levels.random_level() for i in xrange(200))
+        self.assertEqual(picked, set(self.path(f) for f in ["easy_map1.npy", "easy_map2.npy", "hard_map3.npy",
+                                                            "free.npy"]))
+        self.assertEqual(levels.random_level("hard"), self.path("hard_map3.npy"))
+        self.assertIsNone(levels.random_level("medium"))
+
+    def test_saved_across_runs(self):
+        manifest.LevelManifest(self.levels, self.filename).refresh()
+        levels = manifest.LevelManifest(self.levels, self.filename)
+        self.assertEqual(len(levels.entries), 4)
+        self.assertEqual(levels.entries["hard_map3.npy"].rows, 5)
+
+    def test_added_and_modified_levels(self):
+        levels = manifest.LevelManifest(self.levels, self.filename)
+        hash = levels.entry(self.path("easy_map1.npy")).hash
+
+        # levels modified in place are rescanned on the next run
+        np.save(self.path("easy_map1.npy"), np.ones((12, 20, 3), np.uint8))
+        levels = manifest.LevelManifest(self.levels, self.filename)
+        entry = levels.entry(self.path("easy_map1.npy"))
+        self.assertNotEqual(entry.hash, hash)
+        self.assertEqual(entry.rows, 12)
+
+        # added levels are found as soon as the directory changes
+        np.save(self.path("hard_map4.npy"), np.zeros((5, 5, 3), np.uint8))
+        os.utime(self.levels, (0, levels.mtime + 10))
+        self.assertEqual(len(levels.levels("hard")), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+
+import numpy as np
+
+import config
+import masking
+import utils
+
+
+FOREST_COLOR = [34, 85, 34]
+
+
+# returns a map with forest on its left half and noise elsewhere
+def make_map(rows, cols, seed):
+    pixels = np.random.RandomState(seed).randint(0, 256, size=(rows, cols, 4)).astype(np.uint8)
+    pixels[:, :cols // 2, :3] = FOREST_COLOR
+    pixels[:, :, 3] = 255
+    return utils.ImageArray(rows, cols, pixels)
+
+
+class BandsTest(unittest.TestCase):
+    def setUp(self):
+        random = np.random.RandomState(0)
+        self.field = masking.ColorField(make_map(97, 61, 0), FOREST_COLOR)
+        self.region = self.field.region((0, 97, 0, 61))
+        self.plane = random.choice([masking.IGNORE, masking.IGNORE, masking.FOREST], size=(97, 61)).astype(np.uint8)
+        self.fragment = random.randint(0, 3, size=(97, 61)).astype(np.uint8)
+
+    def assertSameComparison(self, expected, compared):
+        self.assertTrue(np.array_equal(expected[0], compared[0]))
+        self.assertEqual(expected[1:], compared[1:])
+
+    def test_bands_match_serial(self):
+        expected = masking.compare(self.field, self.region, self.plane, self.fragment)
+        # including more workers than rows, which leaves some of them without a band
+        for workers in [1, 2, 3, 8, 200]:
+            compared = masking.compare_bands(self.field, self.region, self.plane, self.fragment, workers)
+            self.assertSameComparison(expected, compared)
+
+    def test_empty_region(self):
+        rect = (0, 0, 0, 61)
+        expected = masking.compare(self.field, self.field.region(rect), self.plane[:0], self.fragment[:0])
+        compared = masking.compare_bands(self.field, self.field.region(rect), self.plane[:0], self.fragment[:0], 4)
+        self.assertSameComparison(expected, compared)
+
+
+class MaskTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = config.mask_workers, config.mask_parallel_threshold, config.color_metric
+        self.imdata = make_map(120, 160, 1)
+        self.fragment = np.full((40, 40), masking.FOREST, np.uint8)
+        self.fragment[:10] = masking.NOT_FOREST
+        self.fragment[:, :5] = masking.IGNORE
+
+    def tearDown(self):
+        config.mask_workers, config.mask_parallel_threshold, config.color_metric = self.saved
+
+    # labels a few overlapping fragments in turn, returning the results of every validation and the final labels
+    def run_masks(self, forest):
+        labels = masking.LabelPlane(self.imdata.rows, self.imdata.cols)
+        outcomes = []
+        for rotation, (x, y) in [(0, (0.05, 0.3)), (30, (0.1, 0.4)), (45, (0.6, 0.2)), (90, (0.3, 0.5))]:
+            outcomes.append(masking.mask(self.imdata, labels, forest, self.fragment, rotation, x, y, x + 0.3, y + 0.4))
+        return outcomes, labels.data
+
+    def assertSameMasks(self, expected, masked):
+        self.assertEqual(expected[0], masked[0])
+        self.assertTrue(np.array_equal(expected[1], masked[1]))
+
+    def test_parallel_matches_serial(self):
+        field = masking.ColorField(self.imdata, FOREST_COLOR)
+        config.mask_workers = 1
+        expected = self.run_masks(field)
+        self.assertTrue(any(valid for valid, progress, rect in expected[0]))
+        config.mask_workers, config.mask_parallel_threshold = 4, 0
+        self.assertSameMasks(expected, self.run_masks(field))
+
+    def test_color_field_matches_color(self):
+        expected = self.run_masks(FOREST_COLOR)
+        self.assertSameMasks(expected, self.run_masks(masking.ColorField(self.imdata, FOREST_COLOR)))
+
+    def test_color_field_near_threshold(self):
+        # colors on both sides of the threshold, where rounding differences would show
+        pixels = self.imdata.data.copy()
+        pixels[:, :80, 0] = FOREST_COLOR[0] + np.arange(80) % (2 * config.forest_threshold + 3)
+        self.imdata = utils.ImageArray(self.imdata.rows, self.imdata.cols, pixels)
+        for metric in ["l1", "perceptual"]:
+            config.color_metric = metric
+            expected = self.run_masks(FOREST_COLOR)
+            self.assertSameMasks(expected, self.run_masks(masking.ColorField(self.imdata, FOREST_COLOR)))
+
+
+if __name__ == '__main__':
+    unittest.main()
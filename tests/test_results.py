@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import masking
+import results
+
+
+class EncodeTest(unittest.TestCase):
+    def setUp(self):
+        # planes are encoded one band of (1 << 22) pixels at a time, so bands of these planes are 4 rows high
+        self.cols = (1 << 22) // 4
+
+    def check(self, plane):
+        values, lengths = results.encode(plane)
+        self.assertTrue((lengths > 0).all())
+        self.assertTrue((values[1:] != values[:-1]).all())
+        self.assertTrue((results.decode(values, lengths, plane.rows, plane.cols) == plane.data).all())
+
+    def test_uniform_bands(self):
+        plane = masking.LabelPlane(16, self.cols)
+        plane.data[1, 5:10] = masking.FOREST
+        self.check(plane)
+
+    def test_uniform_plane(self):
+        plane = masking.LabelPlane(16, self.cols)
+        self.check(plane)
+        values, lengths = results.encode(plane)
+        self.assertEqual(list(values), [masking.IGNORE])
+        self.assertEqual(list(lengths), [plane.size])
+
+    def test_random_bands(self):
+        rng = np.random.RandomState(0)
+        plane = masking.LabelPlane(24, self.cols)
+        for top in xrange(0, 24, 4):
+            if rng.rand() < 0.5:
+                plane.data[top:top + 4] = rng.randint(0, 3, (4, self.cols))
+            else:
+                plane.data[top:top + 4] = rng.randint(0, 3)
+        self.check(plane)
+
+    def test_empty_plane(self):
+        values, lengths = results.encode(masking.LabelPlane(0, 10))
+        self.assertEqual(len(values), 0)
+        self.assertEqual(len(lengths), 0)
+
+
+class SaveTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        plane = masking.LabelPlane(30, 40)
+        plane.data[3:20, 5:9] = masking.FOREST
+        plane.data[25:, :] = masking.NOT_FOREST
+        path = os.path.join(self.directory, "sub", "level_result_1.npz")
+        results.save(path, plane, {"level": "level", "rows": 30, "cols": 40})
+
+        labels, meta = results.load(path)
+        self.assertTrue((labels == plane.data).all())
+        self.assertEqual(meta["level"], "level")
+        self.assertEqual(results.load_meta(path), meta)
+        self.assertEqual(os.listdir(os.path.dirname(path)), ["level_result_1.npz"])
+
+
+if __name__ == '__main__':
+    unittest.main()
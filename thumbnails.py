@@ -0,0 +1,75 @@
+from kivy.clock import mainthread
+from PIL import Image
+
+import hashlib
+import os
+import Queue
+import threading
+import traceback
+
+import config
+import tiles
+import utils
+
+
+# returns the path of the cached thumbnail of a level, keyed by the level's path and modification time
+def thumbnail_path(source):
+    key = "%s:%r" % (os.path.abspath(source), os.path.getmtime(source))
+    return os.path.join(config.thumbnail_directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".png")
+
+
+# creates the thumbnail of a level if it isn't cached yet, and returns its path
+def make_thumbnail(source):
+    path = thumbnail_path(source)
+    if os.path.exists(path):
+        return path
+
+    size = (config.thumbnail_size, config.thumbnail_size)
+    if tiles.is_large(source):
+        # large levels use the smallest fitting pyramid level of their tile store
+        image = Image.fromarray(tiles.open_level(source).render(config.thumbnail_size)[0])
+    else:
+        image = Image.open(source)
+        image.draft(image.mode, size)
+    image.thumbnail(size)
+
+    utils.write_atomic(path, lambda f: image.save(f, "PNG"))
+    return path
+
+
+# creates thumbnails on a background thread, and hands them out on the main thread
+class ThumbnailLoader(object):
+    def __init__(self):
+        self._jobs = Queue.Queue()
+
+        worker = threading.Thread(target=self._work)
+        worker.daemon = True
+        worker.start()
+
+    # calls "callback" on the main thread with the thumbnail path of the level (None if it can't be created)
+    # already cached thumbnails are handed out right away
+    def request(self, source, callback):
+        path = thumbnail_path(source)
+        if os.path.exists(path):
+            callback(path)
+        else:
+            self._jobs.put((source, callback))
+
+    # background thread, creating thumbnails one after the other
+    def _work(self):
+        while True:
+            source, callback = self._jobs.get()
+            path = None
+            try:
+                path = make_thumbnail(source)
+            except Exception:
+                traceback.print_exc()
+            self._deliver(callback, path)
+
+    @mainthread
+    def _deliver(self, callback, path):
+        callback(path)
+
+
+# loader shared across the whole application
+LOADER = ThumbnailLoader()
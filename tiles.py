@@ -0,0 +1,311 @@
+from PIL import Image
+
+import hashlib
+import json
+import numpy as np
+import os
+import shutil
+import tempfile
+import threading
+
+import config
+import masking
+import utils
+
+
+# tiled maps are far beyond the size PIL considers a decompression bomb, which it would refuse to open
+Image.MAX_IMAGE_PIXELS = None
+
+
+# tiled backend for very large maps
+# levels are converted once into a tile store: a directory containing a multi-resolution pyramid,
+# each level being a memory-mapped array of fixed-size tiles (rows of tiles, columns of tiles, tile, tile, channels)
+# only the tiles that are actually read or written are ever loaded into memory
+# raw ".npy" levels are read one band of rows at a time and converted by the game when first opened, while other
+# formats (such as PNG) have to be decoded whole, so they are converted offline, before the game is run:
+#
+# usage: python tiles.py [LEVEL ...] [--force]
+
+
+# splits the [start, stop) range of an axis sampled every "step" pixels into per-tile pieces
+# returns a list of (tile index, slice within the tile, slice within the output) tuples
+def _pieces(start, stop, step, tile):
+    count = max(0, (stop - start + step - 1) // step)
+    pieces = []
+    i = 0
+    while i < count:
+        pos = start + i * step
+        index = pos // tile
+        local = pos - index * tile
+        # number of samples remaining within this tile
+        n = min(count - i, (tile - local + step - 1) // step)
+        pieces.append((index, slice(local, local + (n - 1) * step + 1, step), slice(i, i + n)))
+        i += n
+    return pieces
+
+
+# 2d array (with optional channels) stored as tiles, typically memory-mapped
+class TiledArray(object):
+    # - "tiles" is the array of tiles, of shape (rows of tiles, columns of tiles, tile, tile[, channels])
+    # - "rows" and "cols" are the size of the actual data, the last tiles being padded
+    def __init__(self, tiles, rows, cols):
+        self.tiles = tiles
+        self.rows = rows
+        self.cols = cols
+        self.tile = tiles.shape[2]
+
+    # returns a copy of the (top, bottom, left, right) region, keeping one pixel every "step" pixels
+    # only the tiles overlapping the region are read
+    def region(self, rect, step=1):
+        top, bottom, left, right = rect
+        bottom, right = min(bottom, self.rows), min(right, self.cols)
+        rows = _pieces(top, bottom, step, self.tile)
+        cols = _pieces(left, right, step, self.tile)
+
+        shape = (max(0, (bottom - top + step - 1) // step), max(0, (right - left + step - 1) // step))
+        out = np.empty(shape + self.tiles.shape[4:], dtype=self.tiles.dtype)
+        for ty, tile_rows, out_rows in rows:
+            for tx, tile_cols, out_cols in cols:
+                out[out_rows, out_cols] = self.tiles[ty, tx, tile_rows, tile_cols]
+        return out
+
+    # writes the values of a full-resolution (top, bottom, left, right) region back into the tiles
+    def store(self, rect, values):
+        top, bottom, left, right = rect
+        for ty, tile_rows, out_rows in _pieces(top, min(bottom, self.rows), 1, self.tile):
+            for tx, tile_cols, out_cols in _pieces(left, min(right, self.cols), 1, self.tile):
+                self.tiles[ty, tx, tile_rows, tile_cols] = values[out_rows, out_cols]
+
+
+# returns the shape of the tile array needed to store an image of the given size
+def _tile_shape(rows, cols, tile, channels=()):
+    return (-(-rows // tile), -(-cols // tile), tile, tile) + channels
+
+
+# map pixel data stored in a tile store, usable in place of an ImageArray
+class TiledImage(object):
+    def __init__(self, directory):
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+
+        self.directory = directory
+        self.rows = meta["rows"]
+        self.cols = meta["cols"]
+        self.size = self.rows * self.cols
+        self.tile = meta["tile"]
+
+        # pyramid of levels, each one half the size of the previous one
+        self.levels = [TiledArray(np.load(os.path.join(directory, "level_%d.npy" % k), mmap_mode="r"), rows, cols)
+                       for k, (rows, cols) in enumerate(meta["levels"])]
+
+    def __str__(self):
+        return "Tiled image of size " + str(self.rows) + "x" + str(self.cols)
+
+    # returns a (top, bottom, left, right) region of the full-resolution image
+    def region(self, rect, step=1):
+        return self.levels[0].region(rect, step)
+
+    # returns the whole image from the finest pyramid level that fits within "size" pixels in both dimensions,
+    # and the step (in full-resolution pixels) between two pixels of the returned image
+    def render(self, size):
+        for k, level in enumerate(self.levels):
+            if max(level.rows, level.cols) <= size or k == len(self.levels) - 1:
+                return level.region((0, level.rows, 0, level.cols)), 2 ** k
+
+
+# label plane stored as tiles in a temporary memory-mapped file, for use with tiled maps
+# the file is sparse, so only the tiles that have been labeled use disk space
+class TiledLabelPlane(masking.LabelPlane):
+    def __init__(self, rows, cols, tile=None):
+        self.rows = rows
+        self.cols = cols
+        self.size = rows * cols
+        self.counts = [self.size, 0, 0]
+
+        tile = tile or config.tile_size
+        tiles = np.memmap(tempfile.TemporaryFile(), dtype=np.uint8, mode="w+", shape=_tile_shape(rows, cols, tile))
+        self.data = TiledArray(tiles, rows, cols)
+
+    def region(self, rect, step=1):
+        return self.data.region(rect, step)
+
+    def store(self, rect, region):
+        self.data.store(rect, region)
+
+
+# returns the size of an image file as (rows, cols), without decoding it
+def image_size(path):
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r").shape[:2]
+    cols, rows = Image.open(path).size
+    return rows, cols
+
+
+# returns whether the level at the given path is large enough to be loaded as tiles
+def is_large(path):
+    return max(image_size(path)) > config.tile_threshold
+
+
+# returns whether a level can be converted one band of rows at a time, without decoding it whole
+def streamable(path):
+    return path.endswith(".npy")
+
+
+# returns a function reading bands of rows of a source image as RGBA uint8 arrays, and the image size
+# ".npy" files are memory-mapped and read band by band, other formats are decoded once by PIL
+def _open_source(path):
+    if path.endswith(".npy"):
+        data = np.load(path, mmap_mode="r")
+    else:
+        image = Image.open(path)
+        data = image if image.mode == "RGBA" else image.convert("RGBA")
+
+    if isinstance(data, np.ndarray):
+        def band(top, bottom):
+            rows = np.asarray(data[top:bottom], dtype=np.uint8)
+            if rows.shape[2] == 4:
+                return rows
+            return np.concatenate([rows[:, :, :3], np.full(rows.shape[:2] + (1,), 255, np.uint8)], axis=2)
+        return band, data.shape[:2]
+
+    cols, rows = data.size
+    return lambda top, bottom: np.asarray(data.crop((0, top, cols, bottom))), (rows, cols)
+
+
+# halves the size of an image region by averaging blocks of 2x2 pixels
+def _downsample(region):
+    rows, cols = region.shape[:2]
+    region = np.pad(region, ((0, rows % 2), (0, cols % 2), (0, 0)), mode="edge").astype(np.uint16)
+    blocks = region.reshape(region.shape[0] // 2, 2, region.shape[1] // 2, 2, region.shape[2])
+    return ((blocks.sum(axis=3).sum(axis=1) + 2) // 4).astype(np.uint8)
+
+
+# converts a level image (or a raw ".npy" array) into a tile store in the given directory
+# the conversion only holds one band of tiles in memory at a time
+def convert(source, directory, tile=None):
+    tile = tile or config.tile_size
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    band, (rows, cols) = _open_source(source)
+
+    # full-resolution level, filled one band of tiles at a time
+    shape = _tile_shape(rows, cols, tile, (4,))
+    level = np.lib.format.open_memmap(os.path.join(directory, "level_0.npy"), mode="w+", dtype=np.uint8, shape=shape)
+    for ty in range(shape[0]):
+        pixels = band(ty * tile, min(rows, (ty + 1) * tile))
+        for tx in range(shape[1]):
+            part = pixels[:, tx * tile:(tx + 1) * tile]
+            level[ty, tx, :part.shape[0], :part.shape[1]] = part
+    level.flush()
+    levels = [(rows, cols)]
+
+    # pyramid levels, until the whole image fits in a single tile
+    previous = TiledArray(level, rows, cols)
+    while max(previous.rows, previous.cols) > tile:
+        rows, cols = -(-previous.rows // 2), -(-previous.cols // 2)
+        shape = _tile_shape(rows, cols, tile, (4,))
+        level = np.lib.format.open_memmap(os.path.join(directory, "level_%d.npy" % len(levels)),
+                                          mode="w+", dtype=np.uint8, shape=shape)
+        for ty in range(shape[0]):
+            for tx in range(shape[1]):
+                part = _downsample(previous.region((2 * ty * tile, 2 * (ty + 1) * tile,
+                                                    2 * tx * tile, 2 * (tx + 1) * tile)))
+                level[ty, tx, :part.shape[0], :part.shape[1]] = part
+        level.flush()
+        levels.append((rows, cols))
+        previous = TiledArray(level, rows, cols)
+
+    # metadata is written last, so that interrupted conversions are redone
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump({"source": source, "mtime": os.path.getmtime(source), "size": os.path.getsize(source),
+                   "rows": levels[0][0], "cols": levels[0][1], "tile": tile, "levels": levels}, f)
+
+
+# locks of the tile stores, by directory, held while a store is checked and converted
+# levels are opened by both the level loader and the thumbnail worker
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+# returns the lock of a tile store
+def _store_lock(directory):
+    with _locks_lock:
+        return _locks.setdefault(directory, threading.Lock())
+
+
+# returns the tile store directory of a level
+# stores are named after the level and a hash of its full path, so that levels of the same name in different
+# directories (such as local and downloaded levels) have their own
+def store_directory(source):
+    name = os.path.splitext(os.path.basename(source))[0]
+    return os.path.join(config.tile_directory, "%s-%s" % (name, hashlib.sha1(os.path.abspath(source)).hexdigest()[:12]))
+
+
+# returns whether the tile store of a level is missing, or was converted from another version of the level
+def _stale(source, directory):
+    meta = os.path.join(directory, "meta.json")
+    if not os.path.exists(meta):
+        return True
+    with open(meta) as f:
+        meta = json.load(f)
+    return (meta.get("mtime"), meta.get("size")) != (os.path.getmtime(source), os.path.getsize(source))
+
+
+# moves a converted tile store into place, replacing the previous one
+def _replace(temporary, directory):
+    if os.path.exists(directory):
+        previous = temporary + ".old"
+        os.rename(directory, previous)
+        os.rename(temporary, directory)
+        shutil.rmtree(previous, ignore_errors=True)
+    else:
+        os.rename(temporary, directory)
+
+
+# returns the TiledImage of a level, converting it first if it has no up-to-date tile store yet
+# levels are converted into a temporary directory that is renamed once complete, so that a store is never read
+# while it's being written
+# - "offline" allows converting levels that have to be decoded whole, as command-line tools do,
+#   only ".npy" levels are converted otherwise (the game's loading threads must not run out of memory)
+def open_level(source, offline=False):
+    directory = store_directory(source)
+    with _store_lock(directory):
+        if _stale(source, directory):
+            if not (offline or streamable(source)):
+                raise IOError("%s has no up-to-date tile store, convert it with: python tiles.py %s" % (source, source))
+            utils.make_directory(config.tile_directory)
+            temporary = tempfile.mkdtemp(prefix=os.path.basename(directory) + ".", suffix=".tmp",
+                                         dir=config.tile_directory)
+            try:
+                convert(source, temporary)
+                _replace(temporary, directory)
+            finally:
+                shutil.rmtree(temporary, ignore_errors=True)
+
+        return TiledImage(directory)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Converts the large Forest Defenders 2 levels into tile stores")
+    parser.add_argument("levels", nargs="*", help="level files (the large levels of the level directory by default)")
+    parser.add_argument("--force", action="store_true", help="convert levels even if their tile store is up to date")
+    options = parser.parse_args()
+
+    sources = options.levels or sorted(os.path.join(config.level_directory, f)
+                                       for f in os.listdir(config.level_directory))
+    for source in sources:
+        try:
+            if not options.levels and not is_large(source):
+                continue
+        except IOError:
+            # not an image, so not a level
+            continue
+        if options.force:
+            shutil.rmtree(store_directory(source), ignore_errors=True)
+        up_to_date = not _stale(source, store_directory(source))
+        image = open_level(source, offline=True)
+        print "%s: %dx%d, %d pyramid levels%s" % (source, image.rows, image.cols, len(image.levels),
+                                                  " (up to date)" if up_to_date else "")
@@ -1,16 +1,72 @@
-from kivy.graphics.texture import Texture
-
 import errno
+import hashlib
+import json
 import numpy as np
 import os
-from scipy import misc
+
+import config
+import profiling
+
+
+# creates a directory and its parents if they don't exist yet, even if another thread or process creates them meanwhile
+def make_directory(path):
+    if path and not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+# writes a file through "write", which is given the file opened in binary mode, creating its directory if needed
+# the file is written under a temporary name first and renamed once complete, so that interrupted writes are never read
+def write_atomic(path, write):
+    make_directory(os.path.dirname(path))
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        write(f)
+    # renaming doesn't replace existing files on Windows
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(temporary, path)
+
+
+# returns a new empty RGBA texture of the given (width, height) size
+# kivy is imported on first use, so that the tools that only need the other helpers of this module don't load it
+def create_texture(size):
+    from kivy.graphics.texture import Texture
+    return Texture.create(size=size, colorfmt="rgba")
+
+
+# returns the bytes of an RGBA pixel array, flipped vertically as kivy textures start from the bottom row
+def texture_buffer(array):
+    return np.ascontiguousarray(array[::-1], dtype=np.uint8).tobytes()
 
 
-# represents an image in easily-editable format, with data in the form of an rgb or rgba numpy matrix
-class ImageArray:
+# blits an RGBA pixel array into a texture, with the array's top-left pixel at the (row, col) index "pos"
+# - "rows" is the row count of the whole image the texture corresponds to
+def blit_array(tex, array, rows, pos=(0, 0)):
+    height, width = array.shape[:2]
+    if height and width:
+        tex.blit_buffer(texture_buffer(array), size=(width, height), pos=(pos[1], rows - pos[0] - height),
+                        colorfmt='rgba', bufferfmt='ubyte')
+    return tex
+
+
+# returns a new texture containing an RGBA pixel array
+def array_texture(array):
+    tex = create_texture((array.shape[1], array.shape[0]))
+    return blit_array(tex, array, array.shape[0])
+
+
+# represents an image in easily-editable format, with data in the form of an rgba uint8 numpy matrix
+# pixels are shared copy-on-write: images made from existing pixels (including copies and views) keep them read-only
+# and only copy them once they are modified through the image, so "data" must not be written to directly
+class ImageArray(object):
     # creates new image with given row and column size
     # - if data is kept empty, it's initialized as a black transparent image of the given size
-    # - if data is given, it checks that its size corresponds to the given size, then copies its contents
+    # - if data is given, it checks that its size corresponds to the given size, then shares RGBA uint8 pixels,
+    #   and converts anything else (RGB or other types) into a new RGBA uint8 array
     def __init__(self, rows, cols, data=None):
         self.rows = rows
         self.cols = cols
@@ -23,12 +79,16 @@ class ImageArray:
             assert data.shape[2] in [3, 4], "color array is of incorrect dimensions"
 
             if data.shape[2] == 3:
-                self.data[:, :, :3] = data[:, :, :]
+                self.data = np.empty((rows, cols, 4), dtype=np.uint8)
+                self.data[:, :, :3] = data
                 self.data[:, :, 3] = 255
-            elif data.shape[2] == 4:
-                self.data = np.copy(data)
+            elif data.dtype != np.uint8:
+                self.data = data.astype(np.uint8)
+            else:
+                self.data = data.view()
+                self.data.flags.writeable = False
         else:
-            self.data = np.zeros((rows, cols, 4))
+            self.data = np.zeros((rows, cols, 4), dtype=np.uint8)
 
     def __str__(self):
         return "Image array of size " + str(self.rows) + "x" + str(self.cols)
@@ -38,72 +98,163 @@ class ImageArray:
         return self.data.__getitem__(*args)
 
     def __setitem__(self, *args):
-        self.data.__setitem__(*args)
+        self.writable().__setitem__(*args)
+
+    # returns the pixels for modifying them in place, copying them first if they are shared
+    def writable(self):
+        if not self.data.flags.writeable:
+            self.data = self.data.copy()
+        return self.data
 
-    # utility method for faster copying
+    # marks the pixels as shared, so that the next modification of this image copies them first
+    def _share(self):
+        if self.data.flags.writeable:
+            self.data = self.data.view()
+            self.data.flags.writeable = False
+        return self.data
+
+    # returns a (top, bottom, left, right) region of the image data, keeping one pixel every "step" pixels
+    def region(self, rect, step=1):
+        top, bottom, left, right = rect
+        return self.data[top:bottom:step, left:right:step]
+
+    # returns a copy of the image, sharing its pixels until either of them is modified
     def copy(self):
-        return ImageArray(self.rows, self.cols, self.data)
+        return ImageArray(self.rows, self.cols, self._share())
+
+    # returns the (top, bottom, left, right) region of the image as a new image,
+    # sharing its pixels until either of them is modified
+    def view(self, rect):
+        top, bottom, left, right = rect
+        return ImageArray(bottom - top, right - left, self._share()[top:bottom, left:right])
 
     # returns texture for use in kivy, via kivy's "texture" widget attribute
+    @profiling.timed("get_texture")
     def get_texture(self):
-        tex = Texture.create((self.cols, self.rows), colorfmt='rgba')
-        buf = bytearray(0)
-        for x in xrange(self.rows):
-            for y in xrange(self.cols):
-                pixel = self.data[self.rows - 1 - x, y]
-                pixel = map(lambda p: int(p), pixel)
-                buf.extend(pixel)
-        buf = ''.join(map(chr, buf))
-        tex.blit_buffer(buf, colorfmt='rgba', bufferfmt='ubyte')
-        return tex
+        return array_texture(self.data)
+
+    # re-blits a region of the image into a texture previously obtained through "get_texture"
+    # - "rect" is the (top, bottom, left, right) region in array indices, bottom and right excluded
+    def update_texture(self, tex, rect):
+        top, bottom, left, right = rect
+        return blit_array(tex, self.data[top:bottom, left:right], self.rows, (top, left))
+
+    # returns the rgba bytes of the image (or of the given region), flipped vertically for kivy textures
+    def get_buffer(self, rect=None):
+        top, bottom, left, right = rect if rect else (0, self.rows, 0, self.cols)
+        return texture_buffer(self.data[top:bottom, left:right])
 
     # saves the image to a file, creating any directories if they don't already exist
     def save(self, filename):
         assert type(filename) == str, filename + " is not a string"
-        d = os.path.dirname(filename)
-        if d and not os.path.exists(d):
-            try:
-                os.makedirs(d)
-                print "automatically created directory"
-            except OSError as e:
-                if e.errno != errno.EEXIST:
-                    raise
+        make_directory(os.path.dirname(filename))
+        # scipy is slow to import, and only needed once images are read or written
+        from scipy import misc
         misc.imsave(filename, self.data)
 
     # loads an ImageArray from an image file at the given filename
     @staticmethod
+    @profiling.timed("ImageArray.load")
     def load(filename):
         assert type(filename) == str, filename + " is not a string"
+        from scipy import misc
         im = misc.imread(filename)
         (rows, cols) = im.shape[:2]
         return ImageArray(rows, cols, data=im)
 
 
 # utility class for applying various filters to ImageArrays
+# every filter returns a new RGBA uint8 ImageArray, keeping the alpha channel of the original image
+# color filters are applied through 256-entry lookup tables, computed once per image
 class ImageFilter:
     t_min = 10
     t_max = 50
 
+    # returns a new image with the RGB channels of "im" replaced by "rgb" (uint8), and its alpha channel by "alpha"
+    @staticmethod
+    def _with_rgb(im, rgb, alpha=None):
+        data = np.empty(im.data.shape[:2] + (4,), dtype=np.uint8)
+        data[..., :3] = rgb
+        data[..., 3] = im.data[..., 3] if alpha is None else alpha
+        return ImageArray(im.rows, im.cols, data=data)
+
+    # returns a new image with the RGB values of "im" mapped through a 256-entry lookup table
+    @staticmethod
+    def _lookup(im, table):
+        table = np.clip(np.round(table), 0, 255).astype(np.uint8)
+        return ImageFilter._with_rgb(im, table[im.data[..., :3]])
+
+    # returns the cumulative histogram of the RGB values of an image
+    @staticmethod
+    def _cumulative(im):
+        return np.bincount(im.data[..., :3].ravel(), minlength=256).cumsum()
+
     # equalizes the image values via a histogram
     @staticmethod
     def equalize(im):
-        flat = im.data.flatten()
-        hist, bins = np.histogram(flat, 256, normed=True)
-        cdf = hist.cumsum()
-        cdf = 255 * cdf / cdf[-1]
-        return np.interp(flat, bins[:-1], cdf).reshape(im.data.shape)
+        cdf = ImageFilter._cumulative(im)
+        return ImageFilter._lookup(im, 255.0 * cdf / max(1, cdf[-1]))
+
+    # stretches the contrast so that the "low" and "high" percentiles of the values become black and white
+    @staticmethod
+    def stretch(im, low=2, high=98):
+        cdf = ImageFilter._cumulative(im)
+        total = max(1, cdf[-1])
+        darkest = np.searchsorted(cdf, total * low / 100.0)
+        brightest = max(darkest + 1, np.searchsorted(cdf, total * high / 100.0))
+        return ImageFilter._lookup(im, (np.arange(256) - darkest) * 255.0 / (brightest - darkest))
 
-    # converts the image to greyscale
+    # applies a gamma correction, values above 1 brightening the image
+    @staticmethod
+    def gamma(im, value=1.0):
+        return ImageFilter._lookup(im, 255.0 * (np.arange(256) / 255.0) ** (1.0 / value))
+
+    # inverts the colors of the image
+    @staticmethod
+    def invert(im):
+        return ImageFilter._lookup(im, 255 - np.arange(256))
+
+    # converts the image to greyscale, with the (0.299, 0.587, 0.114) luma weights in 16-bit fixed point
     @staticmethod
     def greyscale(im):
-        rows, cols = im.data.shape[:2]
-        image = ImageArray(rows, cols)
-        g = np.dot(im[..., :3], [0.299, 0.587, 0.114])
+        rgb = im.data[..., :3].astype(np.uint32)
+        g = (rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 + 32768) >> 16
+        return ImageFilter._with_rgb(im, g.astype(np.uint8)[..., None], alpha=255)
+
+
+# sequence of ImageFilter filters applied one after the other, its results being cached on disk per level
+# - "steps" is a list of (filter name, options) pairs, such as [("greyscale", {}), ("stretch", {"low": 5})]
+class FilterPipeline(object):
+    def __init__(self, steps):
+        self.steps = [(name, dict(options or {})) for name, options in steps]
+        for name, options in self.steps:
+            assert not name.startswith("_") and hasattr(ImageFilter, name), name + " is not an ImageFilter filter"
+
+        # identifies the pipeline in cache keys
+        self.key = json.dumps(self.steps, sort_keys=True)
+
+    # applies the filters to an ImageArray
+    def apply(self, im):
+        for name, options in self.steps:
+            im = getattr(ImageFilter, name)(im, **options)
+        return im
+
+    # same as "apply", reading the result from the disk cache if it was already computed for this level and size
+    # - "level_hash" identifies the contents of the level, nothing is cached if it isn't known
+    @profiling.timed("filters")
+    def apply_cached(self, im, level_hash):
+        if not self.steps:
+            return im
+        if level_hash is None:
+            return self.apply(im)
 
-        for x in xrange(rows):
-            for y in xrange(cols):
-                image[x, y] = [g[x, y], g[x, y], g[x, y], 255]
+        key = "%s:%s:%dx%d" % (level_hash, self.key, im.rows, im.cols)
+        path = os.path.join(config.filter_cache_directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".npy")
+        if os.path.exists(path):
+            return ImageArray(im.rows, im.cols, data=np.load(path))
 
+        image = self.apply(im)
+        write_atomic(path, lambda f: np.save(f, image.data))
         return image
 
 
@@ -113,7 +264,7 @@ class Gradient(object):
     # generates a horizontal gradient from two non-normalized RGBA colors
     @staticmethod
     def horizontal(rgba_left, rgba_right):
-        texture = Texture.create(size=(2, 1), colorfmt="rgba")
+        texture = create_texture((2, 1))
         pixels = rgba_left + rgba_right
         pixels = [chr(int(v * 255)) for v in pixels]
         buf = ''.join(pixels)
@@ -123,7 +274,7 @@ class Gradient(object):
     # generates a vertical gradient from two non-normalized RGBA colors
     @staticmethod
     def vertical(rgba_top, rgba_bottom):
-        texture = Texture.create(size=(1, 2), colorfmt="rgba")
+        texture = create_texture((1, 2))
         pixels = rgba_bottom + rgba_top
         pixels = [chr(int(v * 255)) for v in pixels]
         buf = ''.join(pixels)